@@ -1,4 +1,7 @@
 from .opticam_pipe import Reduction
 from .opticam_analyse import Analysis
+from .opticam_catalogue import CatalogueStore
+from .opticam_multi import MultiReduction
+from .opticam_calib import Calibration
 from .opticam_etc import Sky, Target, Instrument, Observation, InterpolationMultiplier
 from .Plotter import makeplots
\ No newline at end of file
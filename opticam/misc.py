@@ -1,4 +1,5 @@
 import re
+import numpy as np
 
 def atoi(text):
     return int(text) if text.isdigit() else text
@@ -33,6 +34,32 @@ def snr_all(rate,bkg,time,npix,rn,gain,dark=0.0,binning=1):
 
 
 
+def prefetch(func, items, depth=4, n_threads=None):
+    '''
+    Applies func to the items in background threads, keeping at most
+    `depth` results ready ahead of the consumer, and yields the results
+    in the order of the items. With depth = 0 the items are processed
+    one at a time when they are requested.
+
+    for data in prefetch(fits.getdata, flns, depth=4):
+        ...
+    '''
+    if depth <= 0:
+        for item in items:
+            yield func(item)
+        return
+    from concurrent.futures import ThreadPoolExecutor
+    from collections import deque
+    with ThreadPoolExecutor(max_workers=n_threads or min(depth, 4)) as pool:
+        queue = deque()
+        for item in items:
+            queue.append(pool.submit(func, item))
+            if len(queue) > depth:
+                yield queue.popleft().result()
+        while queue:
+            yield queue.popleft().result()
+
+
 import os
 def rename_folder(folder):
     count = 0
@@ -0,0 +1,226 @@
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+from pathlib import Path
+import astroalign as aa
+
+
+#%%%
+class PixelMatcher:
+    '''
+    Cross-matches the detections of a frame with the reference stars
+    in pixel space.
+
+    The KD-tree of the reference positions is built once and reused for
+    every frame, so matching a frame is a single nearest neighbour query
+    over plain arrays.
+
+    Parameters
+    ----------
+    x, y : float, array
+        Pixel positions of the reference stars
+
+    radius : float, optional
+        Match radius in pixels. Default = 2
+
+    one_to_one : bool, optional
+        If True, a reference star can only be claimed by one detection
+        (the closest one). Default = False
+    '''
+    def __init__(self, x, y, radius=2., one_to_one=False):
+        self.ref = np.column_stack([np.asarray(x, dtype=float), np.asarray(y, dtype=float)])
+        self.tree = cKDTree(self.ref)
+        self.radius = radius
+        self.one_to_one = one_to_one
+
+    def match(self, x, y):
+        """
+        Matches detections to the reference stars.
+
+        x, y: float, array
+            Pixel positions of the detections, already aligned to the
+            reference frame
+
+        Returns
+        -------
+        idx : int, array
+            Index of the closest reference star of every detection
+
+        dist : float, array
+            Distance in pixels to that reference star
+
+        mask : bool, array
+            Detections matched within the radius
+        """
+        pos = np.column_stack([np.asarray(x, dtype=float), np.asarray(y, dtype=float)])
+        if len(pos) == 0 or len(self.ref) == 0:
+            return np.zeros(len(pos), dtype=int), np.full(len(pos), np.inf), np.zeros(len(pos), dtype=bool)
+
+        dist, idx = self.tree.query(pos, k=1)
+        mask = dist < self.radius
+
+        if self.one_to_one:
+            #sorting by reference star and distance, only the first claim is kept
+            cand = np.argwhere(mask).T[0]
+            order = cand[np.lexsort((dist[cand], idx[cand]))]
+            first = np.ones(order.size, dtype=bool)
+            first[1:] = idx[order][1:] != idx[order][:-1]
+            mask[:] = False
+            mask[order[first]] = True
+
+        return idx, dist, mask
+
+
+class FrameAligner:
+    '''
+    Aligns the catalogues of a night to the reference frame.
+
+    The shift of a new frame is first predicted from the frames already
+    aligned (the last shift and its linear extrapolation) and checked
+    against the reference stars with a nearest neighbour query. The
+    astroalign triangle search is only used when no prediction is
+    confirmed. The transforms are saved in a cache, so they are computed
+    only once per frame.
+
+    Shifts follow the astroalign convention: the position of a detection
+    in the reference frame is (x - dx, y - dy).
+
+    Parameters
+    ----------
+    c_ref : float, array (N,2)
+        Positions of the detections of the reference frame
+
+    ref_name : str
+        File name of the reference frame
+
+    path : str, optional
+        CSV file with the transforms cache. Default = None (no cache)
+
+    tolerance : float, optional
+        Search radius in pixels around the predicted positions.
+        Default = 5
+
+    radius : float, optional
+        Maximum distance in pixels of a confirmed match. Default = 2
+
+    min_match : int, optional
+        Minimum number of matched stars to accept a shift. Default = 3
+
+    frac : float, optional
+        Minimum fraction of the stars of the frame (or of the reference,
+        if smaller) matched to accept a shift. Default = 0.3
+    '''
+    columns = ['flname','ref','dx','dy','method','nmatch','residual','mtime']
+
+    def __init__(self, c_ref, ref_name, path=None, tolerance=5., radius=2.,
+                 min_match=3, frac=0.3):
+        self.c_ref = np.asarray(c_ref, dtype=float)
+        self.ref_name = ref_name.split('/')[-1]
+        self.path = path
+        self.radius = radius
+        self.min_match = min_match
+        self.frac = frac
+        self.search = PixelMatcher(self.c_ref[:,0], self.c_ref[:,1],
+                                   radius=tolerance, one_to_one=True)
+        self.history = []
+        self.cache = {}
+        if path is not None and Path(path).exists():
+            tab = pd.read_csv(path, float_precision='round_trip')
+            tab = tab[tab.ref == self.ref_name].drop_duplicates('flname', keep='last')
+            self.cache = {row.flname: row._asdict() for row in tab.itertuples(index=False)}
+
+    def cached(self, name, mtime=None):
+        """
+        True if the transform of the frame is in the cache and up to date
+        """
+        entry = self.cache.get(name.split('/')[-1])
+        return entry is not None and (mtime is None or entry['mtime'] == mtime)
+
+    def align(self, name, c_tar, mtime=None):
+        """
+        Shift (dx, dy) of a frame with respect to the reference frame.
+
+        name: str
+            File name of the frame
+
+        c_tar: float, array (N,2)
+            Positions of the detections of the frame
+
+        mtime: float, optional
+            Modification time of the catalogue, a cached transform is
+            only used if it has not changed
+        """
+        name = name.split('/')[-1]
+        entry = self.cache.get(name)
+        if entry is not None and (mtime is None or entry['mtime'] == mtime):
+            if entry['method'] != 'failed':
+                self.history.append((entry['dx'], entry['dy']))
+            return entry['dx'], entry['dy']
+
+        c_tar = np.asarray(c_tar, dtype=float).reshape(-1,2)
+        if name == self.ref_name:
+            (dx, dy), nmatch, res = (0., 0.), len(c_tar), 0.
+            method = 'reference'
+        else:
+            method = None
+            for d in self._predictions():
+                (dx, dy), nmatch, res = self._check(c_tar, d)
+                if self._accepted(c_tar, nmatch):
+                    method = 'tracked'
+                    break
+            if method is None:
+                try:
+                    p, (pos_img, pos_img_rot) = aa.find_transform(self.c_ref, c_tar)
+                    (dx, dy), nmatch, res = self._check(c_tar, p.translation, refine=False)
+                    method = 'triangles'
+                except:
+                    print('WARNING! >> List of matching triangles exhausted before an acceptable transformation was found?!?!')
+                    (dx, dy) = self.history[-1] if len(self.history) > 0 else (0., 0.)
+                    nmatch, res, method = 0, np.nan, 'failed'
+            print("Translation: (x, y) = ({:.2f}, {:.2f}) [{}]".format(dx, dy, method))
+
+        if method != 'failed':
+            self.history.append((dx, dy))
+        self._save(dict(flname=name, ref=self.ref_name, dx=float(dx), dy=float(dy),
+                        method=method, nmatch=int(nmatch), residual=float(res), mtime=mtime))
+        return dx, dy
+
+    def _predictions(self):
+        """
+        Candidate shifts from the frames already aligned
+        """
+        if len(self.history) == 0:
+            return [(0., 0.)]
+        last = np.array(self.history[-1])
+        if len(self.history) == 1:
+            return [last, np.zeros(2)]
+        return [last, 2*last - np.array(self.history[-2]), np.zeros(2)]
+
+    def _check(self, c_tar, d, refine=True):
+        """
+        Matches the frame shifted by `d` with the reference stars.
+        With refine, the shift is replaced by the median offset of the
+        matched stars. Returns the shift, number of matches within
+        `radius` and their median distance
+        """
+        d = np.asarray(d, dtype=float)
+        idx, dist, mask = self.search.match(c_tar[:,0]-d[0], c_tar[:,1]-d[1])
+        if mask.sum() == 0:
+            return tuple(d), 0, np.nan
+        if refine:
+            d = np.median(c_tar[mask] - self.c_ref[idx[mask]], axis=0)
+        dist = np.hypot(*(c_tar[mask] - d - self.c_ref[idx[mask]]).T)
+        good = dist < self.radius
+        res = np.median(dist[good]) if good.sum() > 0 else np.nan
+        return tuple(d), int(good.sum()), res
+
+    def _accepted(self, c_tar, nmatch):
+        need = max(self.min_match, self.frac*min(len(c_tar), len(self.c_ref)))
+        return nmatch >= need
+
+    def _save(self, entry):
+        self.cache[entry['flname']] = entry
+        if self.path is None:
+            return
+        pd.DataFrame([entry], columns=self.columns).to_csv(self.path, mode='a', index=False,
+                                                          header=not Path(self.path).exists())
@@ -10,10 +10,14 @@ from itertools import permutations
 #import glob
 #from pathlib import Path
 import pandas as pd
-#import os
+import os
 #import aplpy
 from astropy.table import Table
 from .misc import *
+from .opticam_catalogue import CatalogueStore
+from .opticam_forced import forced_frame
+from .opticam_cube import split_id, frame_header, window_offset
+from concurrent.futures import ProcessPoolExecutor
 
 #from astropy.time import Time
 #from statistics import mode
@@ -34,7 +38,11 @@ class Analysis:
         Working directory where the data and catalogues are stored
 
     catalogue : str, optional
-        Directory of all the stars catalogue as measured by SExtractor
+        Directory of all the stars catalogue as measured by SExtractor.
+        Default = None (the folder used by the Reduction, saved in
+        '<name>_files/<name>_Cx_catalogue.txt', including the folder of
+        the configuration with Reduction(config_cache=True), or
+        'catalogues/')
 
     name : str, optional
         Name of the target
@@ -76,15 +84,20 @@ class Analysis:
             self.workdir = './'
         else:
             self.workdir = workdir
-        if catalogue is None: 
-            self.catalogue = 'catalogues/'
-        else:
-            self.catalogue = catalogue
-
         if name is None: 
             self.name = 'astro'
         else:
             self.name = name
+
+        self.marker = '_C'+rule.split('C')[1][0]
+        path_cat = self.workdir+self.name+'_files/'+self.name+self.marker+'_catalogue.txt'
+        if catalogue is not None:
+            self.catalogue = catalogue
+        elif os.path.isfile(path_cat):
+            with open(path_cat) as fl:
+                self.catalogue = fl.read().strip()
+        else:
+            self.catalogue = 'catalogues/'
         #if measurement_id is None:
         #    self.measurement_id = 'ISOCOR'
         #elif measurement_id != 'ISO' and measurement_id != 'ISOCOR' and measurement_id != 'AUTO' and measurement_id != 'BEST' and measurement_id != 'APER' and measurement_id != 'PETRO':
@@ -93,9 +106,17 @@ class Analysis:
         #else:
         self.measurement_id = measurement_id
             
-        self.marker = '_C'+rule.split('C')[1][0]
         #self.aper_size = 5
         self.raw_data = pd.read_pickle(self.workdir+self.name+'_files/'+self.name+self.marker+'_photo.pkl') #.sort_values("MJD")
+        #frames rejected by Reduction.quality_control() are not used
+        path_qc = self.workdir+self.name+'_files/'+self.name+self.marker+'_frame_qc.csv'
+        if os.path.isfile(path_qc):
+            qc = pd.read_csv(path_qc)
+            rejected = set(qc.flname[qc.rejected.astype(bool)])
+            m = np.array([fln.split('/')[-1] not in rejected for fln in self.raw_data.flname])
+            if (~m).sum() > 0:
+                print('Ignoring {} frames rejected by the quality control'.format(len(np.unique(self.raw_data.epoch[~m]))))
+            self.raw_data = self.raw_data[m]
         
         self.path_ref_stars = self.workdir+self.name+'_files/'+self.name+self.marker+'_ref_stars.csv'
         
@@ -603,29 +624,37 @@ class Analysis:
         #aper+=4
         fl2 = self.raw_data.flname.values[image]
         #fl1 = self.workdir+self.catalogue+fl2.split('/')[-1][:-5]+'_cat.fits'
-        fln = fl2.split('/')[-1]
+        fln, k = split_id(fl2.split('/')[-1])
+        tag = '' if k is None else '_f{:05d}'.format(k)
         if fln[-3:] == 'its':
-            fl1 = self.workdir+self.catalogue+fln.split(".fits")[0]+"_cat.fits"
+            fl1 = self.workdir+self.catalogue+fln.split(".fits")[0]+tag+"_cat.fits"
         else:
-            fl1 = self.workdir+self.catalogue+fln.split(".fit")[0]+"_cat.fits"
+            fl1 = self.workdir+self.catalogue+fln.split(".fit")[0]+tag+"_cat.fits"
         aperture = self.apertures[aper]
         #print(self.apertures[aper-4]/2,self.apertures[aper]/2)
         #print((self.apertures[aper-4]/self.apertures[aper]))
         PIX_EDGE = 30
-        texp = fits.getval(fl2,'EXPOSURE')
-        gain = fits.getval(fl2,'GAIN')
-        darkcurr = fits.getval(fl2,'DARKCURR')
+        hdr = frame_header(fl2)
+        texp = hdr['EXPOSURE']
+        gain = hdr['GAIN']
+        darkcurr = hdr['DARKCURR']
         rnoise = 1.1
-        naxis1 = fits.getval(fl2,"NAXIS1")
-        naxis2 = fits.getval(fl2,"NAXIS2")
-        satlevel = fits.getval(fl2,"SATLEVEL")
-        binn = (fits.getval(fl2,"CCDXBIN"))**2
+        naxis1 = hdr["NAXIS1"]
+        naxis2 = hdr["NAXIS2"]
+        satlevel = hdr["SATLEVEL"]
+        binn = (hdr["CCDXBIN"])**2
 
-        print("Binning: {}x{}".format(fits.getval(fl2,"CCDXBIN"),
-                            fits.getval(fl2,"CCDYBIN")))
+        print("Binning: {}x{}".format(hdr["CCDXBIN"],
+                            hdr["CCDYBIN"]))
         circ2pix = 0.78 # approx from circle to pix
         #binn = 1.0
-        data_tmp = fits.getdata(fl1)
+        #reading from the catalogue store if Reduction.catalogue_store() was used
+        data_tmp = None
+        store_path = self.workdir+self.catalogue+'store'+self.marker+'/'
+        if os.path.isdir(store_path):
+            data_tmp = CatalogueStore(store_path).get(fl1)
+        if data_tmp is None:
+            data_tmp = fits.getdata(fl1)
         ss = (data_tmp['FLUX_APER'][:,-2] >0)
         ss&= ((data_tmp['X_IMAGE'] > PIX_EDGE ) & \
              (data_tmp['X_IMAGE'] < naxis1 -PIX_EDGE)  & \
@@ -735,9 +764,101 @@ class Analysis:
                 plt.show()
                 c = 0
                 
-    def forced_photo(self):
-        #self.
-        pass 
+    def forced_photo(self,apertures=None,annulus=None,n_workers=8,save=True):
+        """
+        Forced aperture photometry of all the reference stars in every
+        frame of the photometry, at the positions of the reference list
+        shifted to each frame (see Reduction.frame_aligner). The stars
+        are measured even in the frames where SExtractor did not detect
+        them, without running SExtractor again.
+
+        The frames are read through memory-mapped FITS files in a pool
+        of processes, and all the stars and apertures of a frame are
+        measured at once (see opticam_forced.aperture_photometry).
+
+        Parameters
+        ----------
+        apertures : float, array optional
+            Aperture diameters in pixels. Default = self.apertures
+
+        annulus : tuple, optional
+            Inner and outer radii in pixels of the background annulus.
+            Default = (largest radius + 3, largest radius + 10)
+
+        n_workers : int, optional
+            Number of worker processes. Default = 8
+
+        save : bool, optional
+            Save the photometry in '<name>_files/<name>_Cx_forced_photo'
+            (.csv and .pkl)
+
+        Returns a data frame like the raw photometry, with the columns
+        flux_FORCED_k, flux_err_FORCED_k, mag_FORCED_k and
+        mag_err_FORCED_k of every aperture k
+        """
+        apertures = self.apertures if apertures is None else np.atleast_1d(apertures)
+        radii = np.asarray(apertures, dtype=float)/2.
+        if annulus is None:
+            annulus = (radii.max()+3., radii.max()+10.)
+
+        path_tr = self.workdir+self.name+'_files/'+self.name+self.marker+'_transforms.csv'
+        if not os.path.isfile(path_tr):
+            print('No transforms found in '+path_tr+'\nplease run the photometry of the Reduction first')
+            return
+        tr = pd.read_csv(path_tr, float_precision='round_trip')
+        path_ref = self.workdir+self.name+'_files/'+self.name+self.marker+'_ref_frame.txt'
+        ref_window = None
+        if os.path.isfile(path_ref):
+            with open(path_ref) as fl:
+                ref = fl.read().strip()
+            tr = tr[tr.ref == ref]
+            #the shifts are measured in the readout window of the reference
+            ref = [fln for fln in self.raw_data.flname.unique() if fln.split('/')[-1] == ref]
+            if len(ref) > 0: ref_window = window_offset(frame_header(ref[0]))
+        tr = tr.drop_duplicates('flname', keep='last').set_index('flname')
+
+        #one row per frame of the photometry
+        frames = self.raw_data.drop_duplicates('epoch').sort_values('epoch')
+        frames = frames[[fln.split('/')[-1] in tr.index for fln in frames.flname]]
+        shifts = tr.loc[[fln.split('/')[-1] for fln in frames.flname], ['dx','dy']].values
+
+        ids = self.df_ref_stars.id.values
+        x, y = self.df_ref_stars.x.values, self.df_ref_stars.y.values
+        print('Forced photometry of {} stars in {} frames'.format(ids.size, len(frames)))
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            futures = [pool.submit(forced_frame, fln, x+dx, y+dy, radii, *annulus,
+                                   ref_window=ref_window)
+                       for fln,(dx,dy) in zip(frames.flname.values, shifts)]
+            results = [fut.result() for fut in futures]
+
+        n = ids.size
+        tabs = []
+        for (_, row), (dx,dy), (flux, flux_err, bkg) in zip(frames.iterrows(), shifts, results):
+            rows = {'flname': np.full(n, row.flname, dtype=object),
+                    'id_apass': ids,
+                    'Filter': np.full(n, row.Filter, dtype=object),
+                    'MJD': np.full(n, row.MJD),
+                    'epoch': np.full(n, row.epoch),
+                    'x': x+dx, 'y': y+dy, 'background': bkg}
+            with np.errstate(invalid='ignore', divide='ignore'):
+                for k in range(radii.size):
+                    rows[f'flux_FORCED_{k+1}'] = flux[:,k]
+                    rows[f'flux_err_FORCED_{k+1}'] = flux_err[:,k]
+                    #same zero point as the SExtractor magnitudes
+                    rows[f'mag_FORCED_{k+1}'] = -2.5*np.log10(flux[:,k]) + 2.5*np.log10(row.exptime)
+                    rows[f'mag_err_FORCED_{k+1}'] = 1.0857*flux_err[:,k]/flux[:,k]
+            rows['exptime'] = np.full(n, row.exptime)
+            rows['airmass'] = np.full(n, row.airmass)
+            tabs.append(pd.DataFrame(rows))
+
+        self.forced_data = pd.concat(tabs, ignore_index=True).sort_values(by=['id_apass','epoch'])
+        self.forced_apertures = np.asarray(apertures)
+        if save:
+            path = self.workdir+self.name+'_files/'+self.name+self.marker+'_forced_photo'
+            self.forced_data.to_csv(path+'.csv')
+            self.forced_data.to_pickle(path+'.pkl')
+            print('Files saved in '+path)
+        return self.forced_data
 
 
     
@@ -0,0 +1,122 @@
+import numpy as np
+import warnings
+from scipy.interpolate import PchipInterpolator
+
+
+#%%%
+def comparison_stars(flux, min_frac=0.9, exclude=None):
+    """
+    Stars measured, with positive flux in all the apertures, in at least
+    `min_frac` of the epochs
+
+    flux: float, array (E,S,A)
+        Fluxes of every epoch, star and aperture, NaN if not measured
+
+    exclude: int, array optional
+        Indices of stars that can not be comparison stars (the target)
+
+    Returns a boolean mask of the stars (S)
+    """
+    good = (np.isfinite(flux) & (flux > 0)).all(axis=2).mean(axis=0) >= min_frac
+    if exclude is not None:
+        good[np.atleast_1d(exclude)] = False
+    return good
+
+
+def differential_scatter(flux, comp):
+    """
+    Scatter of the differential photometry of every star in every
+    aperture, all computed at once.
+
+    The differential flux of a star is its flux over the sum of the
+    comparison stars (without itself, if it is one of them), in the
+    epochs where all the comparison stars are measured. The scatter is
+    the robust standard deviation (1.4826 MAD) of its magnitude.
+
+    flux: float, array (E,S,A)
+        Fluxes of every epoch, star and aperture, NaN if not measured
+
+    comp: bool, array (S)
+        Comparison stars
+
+    Returns the scatter in magnitudes and the number of epochs used,
+    both (S,A)
+    """
+    flux = np.where(flux > 0, flux, np.nan)
+    ensemble = flux[:,comp,:].sum(axis=1)
+    own = np.where(comp[None,:,None], flux, 0.)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        others = ensemble[:,None,:] - own
+        mag = -2.5*np.log10(flux / np.where(others > 0, others, np.nan))
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        dev = np.abs(mag - np.nanmedian(mag, axis=0))
+        scatter = 1.4826*np.nanmedian(dev, axis=0)
+    n = np.isfinite(mag).sum(axis=0)
+    scatter[n < 3] = np.nan
+    return scatter, n
+
+
+def best_aperture(scatter):
+    """
+    Index of the aperture with the smallest scatter of every star,
+    -1 if the star has no valid aperture
+    """
+    valid = np.isfinite(scatter).any(axis=1)
+    best = np.full(scatter.shape[0], -1)
+    best[valid] = np.nanargmin(scatter[valid], axis=1)
+    return best
+
+
+def growth_curve(flux, sizes, diameters):
+    """
+    Flux of every star at any aperture diameter, interpolated on its
+    curve of growth (monotonic cubic interpolation between the
+    apertures measured by SExtractor).
+
+    flux: float, array (...,A)
+        FLUX_APER of the stars, any number of leading dimensions (e.g.
+        stars, or frames x stars), the last one the apertures
+
+    sizes: float, array (A)
+        Diameters of the apertures in pixels, increasing, at least two
+
+    diameters: float, array (D)
+        Diameters in pixels where the flux is wanted, within sizes
+
+    Returns the fluxes (...,D)
+    """
+    sizes = np.asarray(sizes, dtype=float)
+    if sizes.size < 2:
+        raise ValueError('the curve of growth needs at least two apertures')
+    diameters = np.clip(np.atleast_1d(np.asarray(diameters, dtype=float)), sizes[0], sizes[-1])
+    flux = np.asarray(flux, dtype=float)
+    return PchipInterpolator(sizes, flux, axis=-1, extrapolate=False)(diameters)
+
+
+def aperture_correction(flux, sizes, diameters, mask=None):
+    """
+    Aperture correction from the diameters to the largest aperture
+    (the total flux): the median ratio of the two fluxes of the stars
+    in `mask`, computed along the axis of the stars (the one before the
+    apertures).
+
+    flux: float, array (...,S,A)
+        FLUX_APER of the stars
+
+    mask: bool, array (...,S), optional
+        Stars used for the correction, e.g. bright and not flagged.
+        Default = None (all the stars with positive fluxes)
+
+    Returns the factors (...,D) that multiply the flux at each diameter
+    """
+    flux = np.asarray(flux, dtype=float)
+    part = growth_curve(flux, sizes, diameters)
+    total = flux[...,-1:]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ratio = np.where((part > 0) & (total > 0), total/part, np.nan)
+    if mask is not None:
+        ratio = np.where(np.asarray(mask)[...,None], ratio, np.nan)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanmedian(ratio, axis=-2)
@@ -0,0 +1,250 @@
+import numpy as np
+import pandas as pd
+from astropy.io import fits
+import glob
+import os
+from .opticam_stack import stack_frames
+from .opticam_cube import window_offset
+
+#master frames already loaded by this process, by path
+_MASTERS = {}
+
+
+#%%%
+def binning(header):
+    """
+    Binning of a frame as in the BINNING keyword, e.g. '2x2'
+    """
+    bnn = header.get('BINNING', None)
+    if isinstance(bnn, str) and 'x' in bnn:
+        return bnn.strip()
+    return '{}x{}'.format(header.get('CCDXBIN', 1), header.get('CCDYBIN', 1))
+
+
+def _master(path):
+    """
+    Master frame, read only once by every process
+    """
+    if path is None:
+        return None
+    mtime = os.path.getmtime(path)
+    if path not in _MASTERS or _MASTERS[path][0] != mtime:
+        _MASTERS[path] = (mtime, fits.getdata(path, 0).astype(np.float32))
+    return _MASTERS[path][1]
+
+
+def _window(master, shape, header):
+    """
+    Part of a full-frame master under the readout window of a frame
+    """
+    if master is None or master.shape == tuple(shape):
+        return master
+    x0, y0 = [int(round(v)) for v in window_offset(header)]
+    return master[y0:y0+shape[0], x0:x0+shape[1]]
+
+
+def calibrate(data, header, masters):
+    """
+    Bias, dark and flat correction of a science frame.
+
+    data: array
+        Image of the frame
+
+    header: fits header
+        Header of the frame, for the binning, exposure time and readout
+        window (the masters are cut to the window of the frame)
+
+    masters: dict
+        Paths of the master frames of every binning, as in
+        Calibration.masters
+
+    Returns the calibrated image (float32), or the image as it was if
+    there are no masters for its binning (see uncalibrated)
+    """
+    paths = masters.get(binning(header), None)
+    if paths is None:
+        return data
+    data = np.asarray(data, dtype=np.float32)
+    bias, dark, flat = [_window(_master(paths.get(kind)), data.shape, header)
+                        for kind in ['bias','dark','flat']]
+    if bias is not None: data = data - bias
+    if dark is not None: data = data - dark*float(header.get('EXPOSURE', 0.))
+    if flat is not None: data = data / flat
+    return data
+
+
+def uncalibrated(headers, masters):
+    """
+    Number of frames of every binning without master frames, from the
+    headers (dicts or fits headers) of the frames to be calibrated
+    """
+    count = {}
+    for header in headers:
+        bnn = binning(header)
+        if bnn not in masters:
+            count[bnn] = count.get(bnn, 0) + 1
+    return count
+
+
+def _stamp(fln):
+    """
+    Name and modification time of a calibration frame, as stored in the
+    HISTORY of the masters
+    """
+    return 'MASTER {} {:.6f}'.format(fln.split('/')[-1], os.path.getmtime(fln))
+
+
+class Calibration:
+    '''
+    Master bias, dark and flat frames of a channel.
+
+    The calibration frames are grouped by binning and combined with a
+    median, tile by tile from the memory-mapped files (see
+    opticam_stack.stack_frames), so long sequences are combined in a
+    bounded amount of memory. The masters are saved in `savedir` and
+    only built again if the list of frames changes, one of the frames is
+    modified or a master they depend on (bias, dark) is built again.
+
+    The masters are applied to the science frames by Reduction.sextractor
+    while the temporary image for SExtractor is written, so no calibrated
+    copy of the frames is kept.
+
+    Parameters
+    ----------
+    workdir : str, optional
+        Working directory. Default './'
+
+    bias, dark, flat : str, optional
+        Folders (inside workdir) with the calibration frames
+
+    rule : str, optional
+        File rule of the frames of the channel. Default '*.fits'
+
+    savedir : str, optional
+        Folder (inside workdir) of the masters. Default 'calibration/'
+
+    Attributes
+    ----------
+    masters : dict
+        Paths of the master frames, {binning: {'bias': path, 'dark':
+        path, 'flat': path}}
+
+    Example
+    -------
+    cal = Calibration(bias='bias/', flat='flats/', rule='C1*.fits')
+    cal.build()
+    '''
+    def __init__(self, workdir=None, bias=None, dark=None, flat=None, rule='*.fits',
+                 savedir='calibration/', vrb=True):
+        self.workdir = './' if workdir is None else workdir
+        self.folders = {'bias': bias, 'dark': dark, 'flat': flat}
+        self.rule = rule
+        self.marker = '_C'+rule.split('C')[1][0] if 'C' in rule else ''
+        self.savedir = self.workdir+savedir
+        self.vrb = vrb
+        self.masters = {}
+
+    def _frames(self, kind):
+        """
+        Calibration frames of a kind with their binning and exposure time
+        """
+        if self.folders[kind] is None:
+            return pd.DataFrame(columns=['fln','binning','exptime'])
+        flns = np.sort(glob.glob(self.workdir+self.folders[kind]+self.rule))
+        headers = [fits.getheader(fln, 0) for fln in flns]
+        return pd.DataFrame(data={'fln': flns,
+                                  'binning': [binning(h) for h in headers],
+                                  'exptime': [float(h.get('EXPOSURE', 0.)) for h in headers],
+                                  'shape': [(h['NAXIS2'], h['NAXIS1']) for h in headers]})
+
+    def _path(self, kind, bnn):
+        return self.savedir+'master_'+kind+self.marker+'_'+bnn+'.fits'
+
+    def _up_to_date(self, path, flns):
+        """
+        True if the master exists and was built from the same frames,
+        none of them modified since
+        """
+        if not os.path.isfile(path):
+            return False
+        header = fits.getheader(path, 0)
+        used = [str(card) for card in header.get('HISTORY', []) if str(card).startswith('MASTER ')]
+        return sorted(used) == sorted(_stamp(fln) for fln in flns)
+
+    def _save(self, kind, bnn, image, header, flns):
+        path = self._path(kind, bnn)
+        for key in ['BZERO','BSCALE','BLANK']:
+            header.remove(key, ignore_missing=True)
+        header['NCOMBINE'] = (len(flns), 'Number of frames combined')
+        header['MASTER'] = kind
+        for fln in flns:
+            header.add_history(_stamp(fln))
+        fits.writeto(path, image.astype(np.float32), header=header, overwrite=True)
+        if self.vrb: print('{} master saved in {}'.format(kind, path))
+        return path
+
+    def build(self, max_memory=512, overwrite=False):
+        """
+        Builds the master frames of every binning.
+
+        - bias: median of the bias frames
+        - dark: median of the bias-subtracted darks divided by their
+          exposure time (dark current per second)
+        - flat: median of the bias and dark subtracted flats, each one
+          normalised by its median, normalised to 1
+
+        max_memory: float, optional
+            Memory in MB used by the frames being combined. Default = 512
+
+        overwrite: bool, optional
+            Build the masters again even if they are up to date
+        """
+        os.makedirs(self.savedir, exist_ok=True)
+        frames = {kind: self._frames(kind) for kind in ['bias','dark','flat']}
+        bins = sorted(set(np.concatenate([frames[kind].binning.values for kind in frames])))
+
+        for bnn in bins:
+            self.masters[bnn] = {}
+            bias, dark = None, None
+            #the masters after a rebuilt one are built again
+            rebuilt = False
+            for kind in ['bias','dark','flat']:
+                tab = frames[kind][frames[kind].binning == bnn]
+                if len(tab) == 0: continue
+                flns = list(tab.fln.values)
+                path = self._path(kind, bnn)
+                if overwrite or rebuilt or not self._up_to_date(path, flns):
+                    rebuilt = True
+                    print('Combining {} {} frames, binning {}'.format(len(flns), kind, bnn))
+                    exptime = tab.exptime.values
+                    if kind == 'bias':
+                        scale = None
+                    elif kind == 'dark':
+                        scale = 1./np.where(exptime > 0, exptime, 1.)
+                    else:
+                        scale = 1./self._levels(flns, bias, dark, exptime)
+                    image, count = stack_frames(flns, np.zeros((len(flns),2)), tab['shape'].values[0],
+                                                scale=scale, max_memory=max_memory,
+                                                bias=bias, dark=dark if kind == 'flat' else None,
+                                                exptime=exptime, vrb=False)
+                    if kind == 'flat':
+                        image /= np.nanmedian(image)
+                        image[~np.isfinite(image) | (image <= 0)] = 1.
+                    self._save(kind, bnn, image, fits.getheader(flns[0], 0), flns)
+                self.masters[bnn][kind] = path
+                if kind == 'bias': bias = _master(path)
+                if kind == 'dark': dark = _master(path)
+        return self.masters
+
+    def _levels(self, flns, bias, dark, exptime, sample=4):
+        """
+        Median level of every flat after the bias and dark subtraction,
+        from one every `sample` pixels
+        """
+        levels = []
+        for fln,t in zip(flns, exptime):
+            data = fits.getdata(fln, 0)[::sample,::sample].astype(np.float32)
+            if bias is not None: data = data - bias[::sample,::sample]
+            if dark is not None: data = data - dark[::sample,::sample]*t
+            levels.append(np.nanmedian(data))
+        return np.array(levels)
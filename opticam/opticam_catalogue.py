@@ -0,0 +1,191 @@
+import numpy as np
+import pandas as pd
+from astropy.io import fits
+from pathlib import Path
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+
+#%%%
+def _read_catalogue(cat_fln):
+    """
+    Reads a SExtractor catalogue into a dict of native byte order arrays.
+    Returns None if the file can not be read
+    """
+    try:
+        data = fits.getdata(cat_fln)
+    except:
+        return None
+    return {col: np.asarray(data[col]).astype(data[col].dtype.newbyteorder('='))
+            for col in data.names}
+
+
+class CatalogueFrame(dict):
+    '''
+    Catalogue of a single frame read from a `CatalogueStore`.
+
+    Columns are memory-mapped arrays and can be accessed either as
+    items, data['X_IMAGE'], or as attributes, data.X_IMAGE, like the
+    FITS_rec returned by fits.getdata.
+    '''
+    def __getattr__(self, col):
+        try:
+            return self[col]
+        except KeyError:
+            raise AttributeError(col)
+
+    @property
+    def names(self):
+        return list(self.keys())
+
+    @property
+    def size(self):
+        return len(next(iter(self.values()))) if len(self) > 0 else 0
+
+
+class CatalogueStore:
+    '''
+    Columnar store of the SExtractor catalogues of a night.
+
+    Every catalogue is read only once. The rows of all the catalogues
+    ingested together are concatenated and each column is saved as a
+    single .npy file (a shard), so the rows of any frame are a slice of
+    a memory-mapped array. An index keeps, for every catalogue file, its
+    modification time, shard and row range.
+
+    Parameters
+    ----------
+    path : str
+        Folder of the store
+
+    Attributes
+    ----------
+    index : data frame
+        Shard and rows (start, stop) of every catalogue, indexed by
+        the catalogue file name
+    '''
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+        self.path_index = os.path.join(self.path, 'index.pkl')
+        if Path(self.path_index).exists():
+            self.index = pd.read_pickle(self.path_index)
+        else:
+            self.index = pd.DataFrame(columns=['mtime','shard','start','stop'])
+        self._maps = {}
+
+    def __contains__(self, cat_fln):
+        return cat_fln.split('/')[-1] in self.index.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def ingest(self, cat_flns, n_workers=8, overwrite=False):
+        """
+        Adds catalogues to the store. Catalogues already stored with
+        the same modification time are skipped, modified ones are read
+        again into a new shard.
+
+        cat_flns: list of str
+            Paths to the SExtractor catalogues
+
+        n_workers: int, optional
+            Number of threads reading the catalogues. Default = 8
+
+        overwrite: bool, optional
+            Remove the store and ingest all the catalogues again
+        """
+        if overwrite:
+            self.index = self.index.iloc[:0]
+            self._remove_unused_shards()
+
+        cat_flns = [fln for fln in cat_flns if os.path.isfile(fln)]
+        names = [fln.split('/')[-1] for fln in cat_flns]
+        mtimes = [os.path.getmtime(fln) for fln in cat_flns]
+        todo = [i for i,name in enumerate(names)
+                if name not in self.index.index or self.index.at[name,'mtime'] != mtimes[i]]
+        if len(todo) == 0:
+            return
+
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            cats = list(pool.map(_read_catalogue, [cat_flns[i] for i in todo]))
+
+        broken = [names[i] for i,cat in zip(todo,cats) if cat is None]
+        if len(broken) > 0:
+            print('WARNING! >> {} catalogues can not be read and are not stored: {}'.format(
+                  len(broken), ', '.join(broken)))
+        todo = [i for i,cat in zip(todo,cats) if cat is not None]
+        cats = [cat for cat in cats if cat is not None]
+        if len(cats) == 0:
+            return
+        #only the columns present in all the catalogues are stored
+        columns = [col for col in cats[0] if all(col in cat for cat in cats)]
+        dropped = sorted(set(col for cat in cats for col in cat) - set(columns))
+        if len(dropped) > 0:
+            missing = {col: sum(col not in cat for cat in cats) for col in dropped}
+            print('WARNING! >> columns not in all the catalogues are not stored: '+
+                  ', '.join('{} (missing in {} of {})'.format(col, n, len(cats))
+                            for col,n in missing.items()))
+
+        shard = 0 if len(self.index) == 0 else int(self.index.shard.max()) + 1
+        while os.path.isdir(self._shard_path(shard)): shard += 1
+        os.makedirs(self._shard_path(shard))
+        for col in columns:
+            np.save(os.path.join(self._shard_path(shard), col+'.npy'),
+                    np.concatenate([cat[col] for cat in cats]))
+
+        stop = np.cumsum([len(cat[columns[0]]) for cat in cats])
+        new = pd.DataFrame(data={'mtime': [mtimes[i] for i in todo],
+                                 'shard': shard,
+                                 'start': np.append(0,stop[:-1]),
+                                 'stop': stop},
+                           index=[names[i] for i in todo])
+        self.index = pd.concat([self.index.drop(index=new.index, errors='ignore'), new])
+        self.index.to_pickle(self.path_index)
+        self._remove_unused_shards()
+
+    def get(self, cat_fln, check=True):
+        """
+        Catalogue of a single frame as a `CatalogueFrame`.
+
+        cat_fln: str
+            Path (or name) of the SExtractor catalogue
+
+        check: bool, optional
+            Return None if the catalogue file was modified after it was
+            ingested. Default = True
+
+        Returns None if the catalogue is not in the store
+        """
+        name = cat_fln.split('/')[-1]
+        if name not in self.index.index:
+            return None
+        entry = self.index.loc[name]
+        if check and os.path.isfile(cat_fln) and os.path.getmtime(cat_fln) != entry.mtime:
+            return None
+        shard, start, stop = int(entry.shard), int(entry.start), int(entry.stop)
+        return CatalogueFrame({col: arr[start:stop] for col,arr in self._shard(shard).items()})
+
+    def _shard_path(self, shard):
+        return os.path.join(self.path, 'shard_{:04d}'.format(shard))
+
+    def _shard(self, shard):
+        """
+        Memory-mapped columns of a shard
+        """
+        if shard not in self._maps:
+            path = self._shard_path(shard)
+            self._maps[shard] = {fl[:-4]: np.load(os.path.join(path, fl), mmap_mode='r')
+                                 for fl in sorted(os.listdir(path)) if fl.endswith('.npy')}
+        return self._maps[shard]
+
+    def _remove_unused_shards(self):
+        """
+        Deletes the shards with no frame left in the index
+        """
+        used = set(self.index.shard.astype(int))
+        for fl in os.listdir(self.path):
+            if fl.startswith('shard_') and int(fl.split('_')[1]) not in used:
+                self._maps.pop(int(fl.split('_')[1]), None)
+                shutil.rmtree(os.path.join(self.path, fl), ignore_errors=True)
@@ -0,0 +1,158 @@
+import numpy as np
+import os
+import re
+from functools import lru_cache
+from astropy.io import fits
+
+#keywords with the time between the frames of a cube, in seconds
+CADENCE_KEYS = ['KCT','CYCLETIM','FRAMETIM','TIMEDEL']
+
+_ID = re.compile(r'^(.*)\[(\d+)\]$')
+
+
+#%%%
+def split_id(fln):
+    """
+    Path and index of a frame. The frames of a cube are named
+    'path[k]', k being the index (0-based) along the third axis;
+    plain files have index None
+    """
+    m = _ID.match(fln)
+    if m is None:
+        return fln, None
+    return m.group(1), int(m.group(2))
+
+
+def frame_path(fln):
+    """
+    Path to the file of a frame
+    """
+    return split_id(fln)[0]
+
+
+def expand_cubes(flns):
+    """
+    Frames of a list of files: every cube (NAXIS = 3) is replaced by
+    one 'path[k]' per plane, the other files are kept as they are
+    """
+    out = []
+    for fln in flns:
+        header = _primary_header(fln, os.path.getmtime(fln))
+        if header.get('NAXIS', 0) == 3 and header.get('NAXIS3', 1) > 1:
+            out += ['{}[{}]'.format(fln, k) for k in range(header['NAXIS3'])]
+        else:
+            out.append(fln)
+    return out
+
+
+@lru_cache(maxsize=64)
+def _primary_header(path, mtime):
+    #the header of a cube is shared by all its frames, it is read once
+    return fits.getheader(path, 0)
+
+
+def cadence(header):
+    """
+    Time in seconds between the starts of two frames of a cube, from
+    CADENCE_KEYS or the exposure time
+    """
+    for key in CADENCE_KEYS:
+        if header.get(key, None) not in [None, '']:
+            return float(header[key])
+    return float(header.get('EXPOSURE', 0.))
+
+
+def window_offset(header):
+    """
+    Position (x0, y0) of the first pixel of a windowed (ROI) readout in
+    the full detector, in pixels of the image, from LTV1/LTV2,
+    XORGSUBF/YORGSUBF or SUBRECT ('x1,x2,y1,y2', unbinned and 1-based).
+    (0, 0) for full frames
+    """
+    if 'LTV1' in header or 'LTV2' in header:
+        return -float(header.get('LTV1', 0.)), -float(header.get('LTV2', 0.))
+    if 'XORGSUBF' in header or 'YORGSUBF' in header:
+        return float(header.get('XORGSUBF', 0.)), float(header.get('YORGSUBF', 0.))
+    if 'SUBRECT' in header:
+        try:
+            x1, x2, y1, y2 = [float(v) for v in str(header['SUBRECT']).split(',')]
+            xbin, ybin = float(header.get('CCDXBIN', 1)), float(header.get('CCDYBIN', 1))
+            return (min(x1,x2)-1)/xbin, (min(y1,y2)-1)/ybin
+        except: pass
+    return 0., 0.
+
+
+def frame_header(fln):
+    """
+    Header of a frame. For a frame of a cube it is the header of the
+    cube as for a 2-D image, with its index (FRAMEIDX) and the time
+    between frames (CADENCE, in seconds). The window offset is added
+    to all the frames (XWINOFF, YWINOFF, see window_offset)
+    """
+    path, k = split_id(fln)
+    header = _primary_header(path, os.path.getmtime(path)).copy()
+    if k is not None:
+        header['NAXIS'] = 2
+        header.remove('NAXIS3', ignore_missing=True)
+        header['FRAMEIDX'] = (k, 'Index of the frame in the cube')
+        header['CADENCE'] = (cadence(header), '[s] Time between frames')
+    header['XWINOFF'], header['YWINOFF'] = window_offset(header)
+    return header
+
+
+class FrameReader:
+    '''
+    Memory-mapped access to the image of a frame, a plain file or a
+    plane of a cube, only the pixels requested are read. The file is
+    opened with the default memmap of astropy, so scaled images
+    (BZERO/BSCALE, e.g. uint16 raw frames) are read as well.
+
+    Example
+    -------
+    with FrameReader('raw/C1_cube.fits[12]') as fr:
+        ny, nx = fr.shape
+        stamp = fr.section(100, 131, 200, 231)
+    '''
+    def __init__(self, fln):
+        self.path, self.k = split_id(fln)
+        self.hdul = fits.open(self.path)
+        self.hdu = self.hdul[0]
+        self.shape = self.hdu.shape[-2:]
+
+    def section(self, a0, a1, b0, b1):
+        """
+        Pixels [a0:a1, b0:b1] (0-based, y and x) of the frame
+        """
+        if self.k is None:
+            return self.hdu.section[a0:a1, b0:b1]
+        return self.hdu.section[self.k, a0:a1, b0:b1]
+
+    def data(self):
+        """
+        Image of the frame
+        """
+        if self.k is None:
+            return self.hdu.data
+        return self.hdu.section[self.k]
+
+    def close(self):
+        self.hdul.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_frame(fln):
+    """
+    Image (as a new array, already scaled) and header of a frame, see
+    frame_header. The scaling keywords are removed from the header
+    """
+    with FrameReader(fln) as fr:
+        data = np.array(fr.data())
+    header = frame_header(fln)
+    for key in ['BZERO','BSCALE','BLANK']:
+        header.remove(key, ignore_missing=True)
+    return data, header
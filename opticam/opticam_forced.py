@@ -0,0 +1,105 @@
+import numpy as np
+import warnings
+from .opticam_movie import read_stamps
+from .opticam_cube import frame_header, window_offset
+
+
+#%%%
+def aperture_photometry(stamps, xc, yc, x0, y0, radii, r_in, r_out):
+    """
+    Aperture photometry of all the stars of a frame at once.
+
+    For every star the pixels of its stamp are sorted by their distance
+    to the centre and accumulated, so the flux inside every radius is
+    read from this curve of growth. The curve is interpolated at the
+    area of the circle (pi r^2 pixels) to account for the partial
+    pixels at the edge of the aperture. The background is the median of
+    the annulus between r_in and r_out.
+
+    stamps: float, array (N,S,S)
+        Stamps of the stars (see read_stamps), NaN outside the frame
+
+    xc, yc: float, array
+        Positions (1-based) of the stars
+
+    x0, y0: int, array
+        Position (1-based) of the first pixel of every stamp
+
+    radii: float, array
+        Aperture radii in pixels
+
+    r_in, r_out: float
+        Inner and outer radii of the background annulus in pixels
+
+    Returns flux, npix (N,R), the background per pixel, its standard
+    deviation and the number of pixels of the annulus (N)
+    """
+    n, size = stamps.shape[0], stamps.shape[-1]
+    radii = np.asarray(radii, dtype=float)
+    grid = np.arange(size)
+    dx = (x0[:,None] + grid[None,:]) - np.asarray(xc, dtype=float)[:,None]
+    dy = (y0[:,None] + grid[None,:]) - np.asarray(yc, dtype=float)[:,None]
+    r = np.hypot(dx[:,None,:], dy[:,:,None]).reshape(n, -1)
+    pix = stamps.reshape(n, -1)
+
+    #local background from the annulus
+    ann = np.where((r >= r_in) & (r < r_out), pix, np.nan)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        bkg = np.nanmedian(ann, axis=1)
+        bkg_std = np.nanstd(ann, axis=1)
+    n_ann = np.isfinite(ann).sum(axis=1)
+
+    #curve of growth of every star
+    order = np.argsort(r, axis=1)
+    r = np.take_along_axis(r, order, axis=1)
+    pix = np.take_along_axis(pix, order, axis=1) - bkg[:,None]
+    bad = np.cumsum(~np.isfinite(pix), axis=1)
+    cum = np.cumsum(np.nan_to_num(pix), axis=1)
+
+    area = np.pi * radii**2
+    k = np.clip(np.floor(area).astype(int), 1, r.shape[1]-1)
+    flux = cum[:,k-1] + (area - k)[None,:] * pix[:,np.minimum(k, r.shape[1]-1)]
+    #apertures with pixels outside the frame are not measured
+    flux[(bad[:,k] > 0) | (radii[None,:] > size//2)] = np.nan
+    return flux, np.broadcast_to(area, flux.shape), bkg, bkg_std, n_ann
+
+
+def forced_frame(fln, x, y, radii, r_in, r_out, gain=None, ref_window=None):
+    """
+    Forced photometry of a frame at the positions (x, y), 1-based, of
+    the stars. Only the stamps of the stars are read from the
+    memory-mapped file.
+
+    gain: float, optional
+        Gain in e-/ADU for the errors. Default = None (GAIN keyword of
+        the frame, or 1)
+
+    ref_window: tuple, optional
+        Offset of the readout window of the frame where (x, y) are
+        measured (see opticam_cube.window_offset), the positions are
+        moved to the window of this frame. Default = None (same window)
+
+    Returns flux, flux_err (N,R) and the background per pixel (N)
+    """
+    size = 2*int(np.ceil(max(r_out, np.max(radii)))) + 3
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    header = frame_header(fln)
+    if ref_window is not None:
+        x0, y0 = window_offset(header)
+        x, y = x - (x0 - ref_window[0]), y - (y0 - ref_window[1])
+    stamps = read_stamps(fln, x, y, size)
+    if gain is None:
+        try: gain = float(header['GAIN'])
+        except: gain = 1.
+    gain = gain if gain > 0 else 1.
+
+    #first pixel of the stamps, as in read_stamps
+    x0 = x.astype(int) - size//2
+    y0 = y.astype(int) - size//2
+    flux, area, bkg, bkg_std, n_ann = aperture_photometry(stamps, x, y, x0, y0,
+                                                          radii, r_in, r_out)
+    sky = (bkg_std**2)[:,None]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        flux_err = np.sqrt(np.abs(flux)/gain + area*sky + area**2*sky/n_ann[:,None])
+    return flux, flux_err, bkg
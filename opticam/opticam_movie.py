@@ -0,0 +1,289 @@
+import numpy as np
+from astropy.io import fits
+import os
+from PIL import Image, ImageDraw, ImageFont, GifImagePlugin
+from .opticam_cube import FrameReader, frame_path
+
+#palette of the movie frames: grey levels plus the colours of the overlay
+GREYS = 252
+GREEN, RED, BLUE, WHITE = 252, 253, 254, 255
+PALETTE = [v for g in np.linspace(0,255,GREYS).astype(int) for v in (g,g,g)] + \
+          [0,160,0, 220,0,0, 0,0,220, 255,255,255]
+
+
+#%%%
+def limits(data, pmin=40., pmax=99., sample=100000):
+    """
+    Black and white levels of an image from its percentiles
+
+    data: float, array
+        Image
+
+    pmin, pmax: float, optional
+        Percentiles of the black and white levels. Default = 40, 99
+
+    sample: int, optional
+        Number of pixels used for the percentiles. Default = 100000
+    """
+    flat = data.ravel()
+    step = max(flat.size // sample, 1)
+    vmin, vmax = np.nanpercentile(flat[::step], [pmin, pmax])
+    return vmin, vmax
+
+
+def stretch(data, vmin, vmax, a=1000., invert=True):
+    """
+    Log stretch of an image into the grey levels of the movie palette,
+    equivalent to aplpy show_grayscale(vmin, vmax, stretch='log').
+
+    a: float, optional
+        Exponent of the log stretch. Default = 1000
+
+    invert: bool, optional
+        Bright sources in black. Default = True
+    """
+    x = np.clip((data - vmin) / max(vmax - vmin, 1e-12), 0., 1.)
+    x = np.log10(a*x + 1.) / np.log10(a + 1.)
+    x = np.nan_to_num(x, nan=0.)
+    if invert: x = 1. - x
+    return np.round(x * (GREYS-1)).astype(np.uint8)
+
+
+def downsample(data, factor):
+    """
+    Block average of an image by an integer factor
+    """
+    if factor <= 1:
+        return data
+    ny, nx = (data.shape[0]//factor)*factor, (data.shape[1]//factor)*factor
+    return data[:ny,:nx].reshape(ny//factor, factor, nx//factor, factor).mean(axis=(1,3))
+
+
+def preview(fln, downscale=1, pmin=40., pmax=99.):
+    """
+    Stretched and downsampled image of a frame, with the first row at
+    the bottom like the FITS file.
+
+    Returns (img, vmin, vmax)
+    """
+    with FrameReader(fln) as fr:
+        data = np.array(fr.data(), dtype=float)
+    vmin, vmax = limits(data, pmin=pmin, pmax=pmax)
+    return stretch(downsample(data, downscale), vmin, vmax), vmin, vmax
+
+
+class PreviewCache:
+    '''
+    Cache of the preview images of the frames (see preview), one .npz
+    file per frame and downscale factor. A preview is computed the
+    first time a frame is used and again only if the frame is modified
+    or the percentiles of the stretch change.
+
+    Parameters
+    ----------
+    path : str
+        Folder of the cache
+
+    Example
+    -------
+    cache = PreviewCache('BL_Cam_files/previews_C1/')
+    img, vmin, vmax = cache.get('raw/C1_0001.fits', downscale=4)
+    plt.imshow(img, origin='lower', cmap='gray', vmin=0, vmax=GREYS-1)
+    '''
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+
+    def _path(self, fln, downscale):
+        return os.path.join(self.path, '{}_x{}.npz'.format(fln.split('/')[-1], int(downscale)))
+
+    def get(self, fln, downscale=1, pmin=40., pmax=99.):
+        """
+        Preview of a frame, (img, vmin, vmax) as in preview()
+        """
+        path = self._path(fln, downscale)
+        mtime = os.path.getmtime(frame_path(fln))
+        if os.path.isfile(path):
+            try:
+                with np.load(path) as z:
+                    if z['mtime'] == mtime and z['pmin'] == pmin and z['pmax'] == pmax:
+                        return z['img'], float(z['vmin']), float(z['vmax'])
+            except: #broken file, computed again
+                pass
+
+        img, vmin, vmax = preview(fln, downscale=downscale, pmin=pmin, pmax=pmax)
+        #written to a temporary file first as several processes share the cache
+        tmp = path+'.{}.tmp'.format(os.getpid())
+        with open(tmp, 'wb') as fl:
+            np.savez(fl, img=img, vmin=vmin, vmax=vmax, mtime=mtime, pmin=pmin, pmax=pmax)
+        os.replace(tmp, path)
+        return img, vmin, vmax
+
+
+def read_stamps(fln, xc, yc, size):
+    """
+    Square stamps of a frame centred at the pixels (xc, yc), 1-based
+    like the SExtractor positions. Only the pixels of the stamps are
+    read from the memory-mapped file, the parts of the stamps outside
+    the frame are NaN.
+
+    Returns a float32 array (len(xc), size, size)
+    """
+    h = size // 2
+    out = np.full((len(xc), size, size), np.nan, dtype=np.float32)
+    with FrameReader(fln) as fr:
+        ny, nx = fr.shape
+        for k,(x,y) in enumerate(zip(xc, yc)):
+            i0, j0 = int(y)-1-h, int(x)-1-h
+            a0, b0 = max(i0,0), max(j0,0)
+            a1, b1 = min(i0+size,ny), min(j0+size,nx)
+            if a1 > a0 and b1 > b0:
+                out[k, a0-i0:a1-i0, b0-j0:b1-j0] = fr.section(a0, a1, b0, b1)
+    return out
+
+
+def stamps_frame(stamps, zoom=4, gap=2):
+    """
+    Frame of the cutout animation: the stamps of the stars side by
+    side, each one with its own stretch, enlarged `zoom` times
+    """
+    tiles = []
+    for st in stamps:
+        if np.isfinite(st).any():
+            vmin, vmax = limits(st, pmin=5., pmax=99.5)
+            tile = stretch(st, vmin, vmax)[::-1]
+        else:
+            tile = np.full(st.shape, WHITE, dtype=np.uint8)
+        tiles.append(np.kron(tile, np.ones((zoom,zoom), dtype=np.uint8)))
+        tiles.append(np.full((tile.shape[0]*zoom, gap), WHITE, dtype=np.uint8))
+    return np.hstack(tiles[:-1])
+
+
+def _font(size):
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError: #older versions of PIL
+        return ImageFont.load_default()
+
+
+def render_frame(fln, x, y, ids, target=None, text='', title='', downscale=1,
+                 pmin=40., pmax=99., radius=13, cache=None):
+    """
+    Renders a frame of the field-of-view movie: the stretched image,
+    with the matched stars circled in green, their ids and the target
+    circled in red.
+
+    fln: str
+        Path to the FITS file
+
+    x, y: float, array
+        SExtractor positions (1-based) of the matched stars
+
+    ids: int, array
+        Identifier of every star in the reference list
+
+    target: int, optional
+        Index in x, y of the target
+
+    text, title: str, optional
+        Labels at the bottom and top of the frame
+
+    downscale: int, optional
+        Block averaging factor of the image. Default = 1
+
+    cache: str, optional
+        Folder of a PreviewCache. Default = None (no cache)
+
+    Returns the frame as an array of indices of PALETTE
+    """
+    if cache is not None:
+        img = PreviewCache(cache).get(fln, downscale=downscale, pmin=pmin, pmax=pmax)[0]
+    else:
+        img = preview(fln, downscale=downscale, pmin=pmin, pmax=pmax)[0]
+    ny = img.shape[0]*max(downscale, 1)
+    #FITS images are shown with the first row at the bottom
+    im = Image.fromarray(np.ascontiguousarray(img[::-1]), mode='P')
+    draw = ImageDraw.Draw(im)
+    f = float(max(downscale, 1))
+    xd = (np.asarray(x) - 0.5)/f - 0.5
+    yd = (ny - np.asarray(y) + 0.5)/f - 0.5
+    r = radius/f
+    font = _font(max(int(24/f), 10))
+    for k in range(len(xd)):
+        draw.ellipse([xd[k]-r, yd[k]-r, xd[k]+r, yd[k]+r], outline=GREEN, width=max(int(3/f),1))
+        draw.text((xd[k]+6/f, yd[k]-6/f-10), str(int(ids[k])), fill=BLUE, font=font)
+    if target is not None:
+        draw.ellipse([xd[target]-r-1, yd[target]-r-1, xd[target]+r+1, yd[target]+r+1],
+                     outline=RED, width=max(int(5/f),1))
+    draw.text((5, 5), title, fill=RED, font=font)
+    draw.text((5, im.size[1]-max(int(24/f), 10)-5), text, fill=RED, font=font)
+    return np.asarray(im)
+
+
+class GifWriter:
+    '''
+    Writes an animated GIF one frame at a time, so only the frame
+    being encoded is kept in memory. All the frames share the palette
+    of the movie (PALETTE).
+
+    Parameters
+    ----------
+    path : str
+        Output file
+
+    fps : float, optional
+        Frames per second. Default = 5
+
+    loop : int, optional
+        Number of loops, 0 is forever. Default = 0
+
+    Example
+    -------
+    with GifWriter('movie.gif') as gif:
+        for frame in frames:
+            gif.write(frame)
+    '''
+    def __init__(self, path, fps=5, loop=0):
+        self.path = path
+        self.duration = int(round(1000./fps))
+        self.loop = loop
+        self.fl = open(path, 'wb')
+        self.size = None
+        self.n = 0
+
+    def _image(self, frame):
+        im = Image.fromarray(np.ascontiguousarray(frame, dtype=np.uint8), mode='P')
+        im.putpalette(PALETTE)
+        return im
+
+    def write(self, frame):
+        """
+        Appends a frame (array of indices of PALETTE). Frames with a
+        different size are padded or cropped to the first one
+        """
+        if self.size is None:
+            self.size = frame.shape
+            header, _ = GifImagePlugin.getheader(self._image(frame),
+                                                 info={'loop': self.loop, 'duration': self.duration,
+                                                       'optimize': False})
+            self.fl.write(b''.join(header))
+        elif frame.shape != self.size:
+            pad = np.full(self.size, WHITE, dtype=np.uint8)
+            ny, nx = min(frame.shape[0], self.size[0]), min(frame.shape[1], self.size[1])
+            pad[:ny,:nx] = frame[:ny,:nx]
+            frame = pad
+        for chunk in GifImagePlugin.getdata(self._image(frame), duration=self.duration,
+                                            optimize=False):
+            self.fl.write(chunk)
+        self.n += 1
+
+    def close(self):
+        if not self.fl.closed:
+            self.fl.write(b';')
+            self.fl.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,195 @@
+import numpy as np
+import pandas as pd
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from .opticam_pipe import Reduction
+
+#attributes of a channel passed to the worker processes
+_STATE = ['path_to_ref_fits','aper_ind','adaptive','cog','binning','fwhm_image','fwhm_image_pix']
+
+
+#%%%
+def _run_channel(kwargs, state, method, margs):
+    """
+    Runs a method of a `Reduction` in a worker process. The reduction
+    is created again from its keywords and the state of the channel
+    """
+    red = Reduction(**kwargs)
+    for key, value in state.items():
+        setattr(red, key, value)
+    getattr(red, method)(**margs)
+    return getattr(red, 'out_df', None)
+
+
+class MultiReduction:
+    '''
+    Reduces the three OPTICAM channels of a night at the same time.
+
+    A `Reduction` is created for every channel (C1, C2 and C3) and
+    all of them share a single pool of worker processes, so the frames
+    of the three cameras are extracted and cross-matched in parallel
+    without oversubscribing the machine.
+
+    Parameters
+    ----------
+    workdir, rawdata, catalogue, name, config_fl_name, sizes, vrb, config_cache, cubes :
+        Same as in `Reduction`, shared by all the channels
+
+    rule : str, optional
+        File rule with a '{}' where the channel goes. Default '{}*.fits'
+
+    channels : list of str, optional
+        Channels to reduce. Default = ['C1','C2','C3']. Channels without
+        files are ignored
+
+    n_workers : int, optional
+        Number of worker processes shared by all the channels.
+        Default = None (number of CPUs)
+
+    Attributes
+    ----------
+    reductions : dict
+        `Reduction` of every channel
+
+    times : data frame
+        Timestamps of the frames of all the channels, see time_index()
+
+    Example
+    -------
+    mr = opticam.MultiReduction(rawdata='raw/', name='BL_Cam', sizes=[10,16])
+    mr.sextractor()
+    mr.creat_ref_list()
+    mr.photometry()
+    mr.time_index()
+    '''
+    def __init__(self, workdir=None, rawdata=None, catalogue=None, name=None,
+                 rule='{}*.fits', channels=['C1','C2','C3'], config_fl_name=None,
+                 sizes=None, vrb=True, n_workers=None, config_cache=False, cubes=False):
+        self.n_workers = n_workers if n_workers is not None else os.cpu_count()
+        self.vrb = vrb
+        self.kwargs = {}
+        self.reductions = {}
+        for ch in channels:
+            kwargs = dict(workdir=workdir, rawdata=rawdata, catalogue=catalogue, name=name,
+                          rule=rule.format(ch), config_fl_name=config_fl_name,
+                          sizes=sizes, vrb=vrb, config_cache=config_cache, cubes=cubes)
+            red = Reduction(**kwargs)
+            if len(red.flns) == 0:
+                print('WARNING! >> No files for channel {}, ignoring it'.format(ch))
+                continue
+            self.kwargs[ch] = kwargs
+            self.reductions[ch] = red
+
+        red = next(iter(self.reductions.values()), None)
+        if red is not None:
+            self.workdir, self.name = red.workdir, red.name
+
+    def __getitem__(self, ch):
+        return self.reductions[ch]
+
+    def _threads(self, func):
+        """
+        Calls func(channel, reduction) for every channel in its own thread
+        """
+        with ThreadPoolExecutor(max_workers=max(len(self.reductions),1)) as threads:
+            futures = {ch: threads.submit(func, ch, red) for ch,red in self.reductions.items()}
+            return {ch: fut.result() for ch,fut in futures.items()}
+
+    def sextractor(self):
+        """
+        Runs SExtractor over the frames of all the channels. The frames
+        of the three channels are queued in the same pool of processes
+        """
+        #the default files are copied only once
+        for red in self.reductions.values():
+            red._sextractor_files()
+        with ProcessPoolExecutor(max_workers=self.n_workers) as pool:
+            self._threads(lambda ch,red: red.sextractor(executor=pool))
+
+    def header_index(self, overwrite=False):
+        """
+        Header index of every channel, see Reduction.header_index
+        """
+        n_workers = max(self.n_workers // max(len(self.reductions),1), 1)
+        return self._threads(lambda ch,red: red.header_index(n_workers=n_workers,
+                                                             overwrite=overwrite))
+
+    def creat_ref_list(self, number=None):
+        """
+        Reference star list of every channel. The field images are
+        plotted, so the channels are done one after the other.
+
+        number: int, optional
+            Index of the reference frame of every channel. Default =
+            None (chosen by Reduction.select_reference)
+        """
+        for red in self.reductions.values():
+            red.creat_ref_list(number=number)
+
+    def photometry(self, **kwargs):
+        """
+        Runs the photometry of all the channels at the same time, each
+        channel in one of the worker processes. The keywords are passed
+        to Reduction.photometry
+        """
+        def run(ch, red):
+            #the reference frame is resolved by Reduction._ref_frame()
+            state = {key: getattr(red, key) for key in _STATE if hasattr(red, key)}
+            out = pool.submit(_run_channel, self.kwargs[ch], state, 'photometry', kwargs).result()
+            if out is not None:
+                red.out_df = out
+            return out
+
+        with ProcessPoolExecutor(max_workers=min(self.n_workers, len(self.reductions))) as pool:
+            return self._threads(run)
+
+    def time_index(self, tolerance=None, save=True):
+        """
+        Combined index of the timestamps of the frames of all the
+        channels, sorted by the mid-exposure time.
+
+        Frames of different channels taken at the same time are given
+        the same `group` number.
+
+        tolerance: float, optional
+            Maximum difference in seconds between the mid-exposure times
+            of the frames of a group. Default = None (half of the
+            shortest exposure time)
+
+        save: bool, optional
+            Save the index in '<name>_files/<name>_time_index.csv'.
+            Default = True
+        """
+        self.header_index()
+
+        tabs = []
+        for ch,red in self.reductions.items():
+            red.decode_times()
+            tabs.append(pd.DataFrame(data={'channel': ch,
+                                           'epoch': np.arange(len(red.flns)),
+                                           'flname': [fln.split('/')[-1] for fln in red.flns],
+                                           'Filter': [red._hdr(fln,"FILTER") for fln in red.flns],
+                                           'MJD': red.mjd,
+                                           'exptime': red.exptime}))
+        tab = pd.concat(tabs, ignore_index=True).sort_values(['MJD','channel'], ignore_index=True)
+
+        if tolerance is None:
+            tolerance = np.nanmin(tab.exptime.values)/2.
+        #a new group starts after a gap or when a channel is repeated
+        group = np.zeros(len(tab), dtype=int)
+        start, seen = 0, set()
+        for i,(ch,mjd) in enumerate(zip(tab.channel.values, tab.MJD.values)):
+            if ch in seen or (mjd - tab.MJD.values[start])*86400. > tolerance:
+                group[i] = group[i-1] + 1
+                start, seen = i, set()
+            elif i > 0:
+                group[i] = group[i-1]
+            seen.add(ch)
+        tab['group'] = group
+
+        self.times = tab
+        if save:
+            path = self.workdir+self.name+'_files/'+self.name+'_time_index.csv'
+            tab.to_csv(path, index=False)
+            if self.vrb: print('Time index saved in '+path)
+        return tab
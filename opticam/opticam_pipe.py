@@ -1,8 +1,6 @@
 import numpy as np
 import matplotlib.pyplot as plt
 from astropy.io import fits
-from astropy.coordinates import SkyCoord
-from astropy import units as u
 import glob
 from pathlib import Path
 import pandas as pd
@@ -11,10 +9,105 @@ import aplpy
 from astropy.time import Time
 import astroalign as aa
 import sys
-from .misc import * #this is to sort the text using the numbers in it  
+import shutil
+import warnings
+import pickle
+import hashlib
+import subprocess
+from contextlib import nullcontext, closing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from .misc import * #this is to sort the text using the numbers in it
+from .opticam_catalogue import CatalogueStore, CatalogueFrame
+from .opticam_align import PixelMatcher, FrameAligner
+from .opticam_aper import comparison_stars, differential_scatter, best_aperture, \
+                          growth_curve, aperture_correction
+from .opticam_stack import stack_frames
+from .opticam_calib import Calibration, calibrate, uncalibrated
+from .opticam_movie import GifWriter, render_frame, PreviewCache, GREYS, read_stamps, stamps_frame
+from .opticam_cube import split_id, frame_path, expand_cubes, frame_header, read_frame
 from astropy.nddata import CCDData
 from astropy.table import Table
 
+#header keywords used along the pipeline, stored in the header index
+HEADER_KEYS = ['FILTER','EXPOSURE','GPSTIME','UT','DATE-OBS','AIRMASS',
+               'NAXIS1','NAXIS2','CCDXBIN','CCDYBIN','L1FWHM','GAIN',
+               'BINNING','DARKCURR','SATLEVEL',
+               'FRAMEIDX','CADENCE','XWINOFF','YWINOFF']
+
+#SExtractor measurement families saved by the photometry
+MEASUREMENT_FAMILIES = ['ISO','ISOCOR','AUTO','BEST','PETRO','APER']
+
+#%%%
+def _read_header(fln):
+    """
+    Reads the primary header of a frame once and returns the
+    values of HEADER_KEYS (None when the keyword is missing). The
+    frames of a cube also have their index and cadence, see
+    opticam_cube.frame_header
+    """
+    header = frame_header(fln)
+    return [header.get(key, None) for key in HEADER_KEYS]
+
+#%%%
+def _sextractor_frame(fln, cat_fln, config_fl_name, workdir, scratch, ccd_pixscale, masters=None):
+    """
+    Runs SExtractor over a single frame.
+
+    The temporary image and catalogue are written into `scratch`, one
+    directory per process, so several frames can be extracted at the same
+    time without touching the working directory of the python process.
+    SExtractor itself runs inside `workdir` where the config files live.
+    With `masters` (see Calibration) the frame is calibrated before it
+    is written to the temporary image.
+
+    Returns
+    -------
+    (binning, fwhm, fwhm_pix) for the frame or None if the file is broken
+    or SExtractor fails (the catalogue of the frame is then removed)
+    """
+    scratch = os.path.join(scratch, str(os.getpid()))
+    os.makedirs(scratch, exist_ok=True)
+    tmp_fln = os.path.join(scratch, 'temp_sextractor_file.fits')
+    tmp_cat = os.path.join(scratch, os.path.basename(cat_fln))
+
+    #hotfix for broken files
+    try: data, header = read_frame(fln)
+    except (OSError, ValueError, TypeError) as err:
+        print('WARNING! >> could not read {}: {}'.format(fln, err))
+        return None
+    hdu1 = fits.PrimaryHDU(data=data)
+    hdu1.header = header
+    if masters is not None:
+        hdu1.data = calibrate(data, header, masters)
+    fits.HDUList([hdu1]).writeto(tmp_fln, overwrite=True)
+    os.chmod(tmp_fln, 0o777)
+
+    gain = header.get('GAIN', 1.0)
+    binning = header.get('BINNING', None)
+    try:
+        bnn = float(binning.split('x')[0])
+    except (AttributeError, ValueError):
+        bnn = 1.
+        print("WARNING: BINNING NOT FOUND")
+
+    proc = subprocess.run(['sextractor', tmp_fln, '-c', config_fl_name,
+                           '-CATALOG_NAME', tmp_cat, '-GAIN', str(gain)], cwd=workdir)
+    os.remove(tmp_fln)
+    if proc.returncode != 0 or not os.path.isfile(tmp_cat):
+        print('WARNING! >> SExtractor failed on {} (exit code {})'.format(fln, proc.returncode))
+        #a partial or outdated catalogue must not be taken for a good one
+        for path in [tmp_cat, cat_fln]:
+            if os.path.isfile(path): os.remove(path)
+        return None
+    shutil.move(tmp_cat, cat_fln)
+
+    #saving the estimated fwhm of the image
+    fwhm = fits.getdata(cat_fln).FWHM_IMAGE
+    PSF_FWHM_pix = np.median(fwhm[fwhm > 0])
+    PSF_FWHM = PSF_FWHM_pix * ccd_pixscale * bnn
+
+    return binning, PSF_FWHM, PSF_FWHM_pix
+
 #%%%
 class Reduction:
     '''
@@ -39,6 +132,11 @@ class Reduction:
         File rule to be used when collecting all the fits files. 
         Default '*.fits'
 
+    config_cache : bool, optional
+        Keep the catalogues of every SExtractor configuration in its
+        own folder, '<catalogue>/cfg_<hash>/', see sextractor().
+        Default False
+
     Attributes
     ----------
 
@@ -65,7 +163,8 @@ class Reduction:
     '''
 #%%
     def __init__(self,workdir=None,rawdata = None,catalogue=None,
-                name=None,rule='*.fits',config_fl_name=None, measurement_id=None, sizes=None,vrb=True):
+                name=None,rule='*.fits',config_fl_name=None, measurement_id=None, sizes=None,vrb=True,
+                config_cache=False,cubes=False):
         
         self.vrb = vrb
         if workdir is None: 
@@ -100,12 +199,21 @@ class Reduction:
             self.measurement_id = measurement_id
             
         self.sizes = np.array([3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,23,24,25,26,27,28,29,30,31,32,33])
+        #apertures of the config file of the working directory, see minimal_param()
+        try:
+            conf = self.read_sex_param(self.workdir+self.config_fl_name)
+            self.sizes = np.array([int(float(x)) for x in
+                                   conf.Values[conf.Variables == 'PHOT_APERTURES'].values[0].split(',')])
+        except: pass
         if isinstance(sizes,type(None)):
             print('No apperture size imputed, setting to default (16 pixels)')
-            self.aper_ind = np.argwhere(self.sizes==16)[0]
+            self.aper_ind = np.argwhere(self.sizes==16)[0] if 16 in self.sizes else np.array([0])
         else:
             #here we implement several apertures
-            self.aper_ind = [np.argwhere(np.array(self.sizes)==x)[0][0] for x in sizes]
+            for x in sizes:
+                if x not in self.sizes:
+                    print('WARNING! >> aperture of {} pix not in PHOT_APERTURES of the config file'.format(x))
+            self.aper_ind = [np.argwhere(np.array(self.sizes)==x)[0][0] for x in sizes if x in self.sizes]
             
         #if measurement_id == 'APER' and size is not None:
         #   
@@ -120,10 +228,22 @@ class Reduction:
         
         self.rule = rule
         self.marker = '_C'+rule.split('C')[1][0]
+        self.cubes = cubes
         self.flns = self.get_files(self.rule)
         self._ROOT = os.path.abspath(os.path.dirname(__file__))
         self.path_ref_list = self.workdir+self.name+'_files/'+self.name+self.marker+'_ref_stars.csv'
-#%%    
+        self.headers = None #header index, see header_index()
+        self.cat_store = None #catalogue store, see catalogue_store()
+        self.aligner = None #alignment engine, see frame_aligner()
+        self.times = None #timestamps, see decode_times()
+        self.calib = None #master calibration frames, see calibration()
+        self.adaptive = None #seeing-adaptive aperture, see set_adaptive_aperture()
+        self.qc = None #quality control of the frames, see quality_control()
+        self.cog = None #interpolated apertures, see set_cog_apertures()
+        self.config_cache = config_cache
+        self._cfg_key = None #hash of the SExtractor configuration, see _config_key()
+        self.manifest = None #inputs of the cached catalogues, see _read_manifest()
+#%%
 
         #setting the pixelscale in the header
         if 'C1' in self.rule:
@@ -166,6 +286,146 @@ class Reduction:
         """
         print('updating aperture diameters (in pixels) to be saved')
         self.aper_ind = [np.argwhere(np.array(self.sizes)==x)[0][0] for x in sizes]
+
+    def set_adaptive_aperture(self,k=None,interpolate=True):
+        """
+        Seeing-adaptive aperture: in every frame an extra aperture of
+        diameter k times the PSF FWHM of the frame (median FWHM_IMAGE)
+        is saved by photometry() as flux_ADAPT, mag_ADAPT, etc., with
+        the diameter used in aper_ADAPT. Saved only with the 'APER'
+        family.
+
+        k: float, optional
+            Diameter of the aperture in units of the FWHM. Default = None
+            (no adaptive aperture)
+
+        interpolate: bool, optional
+            Interpolate the flux between the two closest apertures
+            (sizes), or use the closest one. Default = True
+        """
+        self.adaptive = None if k is None else (float(k), bool(interpolate))
+        if k is not None:
+            print('adaptive aperture of {} x FWHM'.format(k))
+
+    def set_cog_apertures(self,diameters=None,correct=True,snr_min=20.):
+        """
+        Apertures of any diameter, not only those of `sizes`: the flux
+        of every star is interpolated on its curve of growth, built from
+        the FLUX_APER of all the SExtractor apertures (see
+        opticam_aper.growth_curve). photometry() saves them as
+        flux_COG_k, mag_COG_k, etc. Saved only with the 'APER' family.
+
+        diameters: float, array optional
+            Aperture diameters in pixels, within the range of `sizes`.
+            Default = None (no interpolated apertures)
+
+        correct: bool, optional
+            Apply the aperture correction of every frame to the total
+            flux (the largest aperture), from the median curve of growth
+            of the bright stars. The factor is saved in apcor_COG_k.
+            Default = True
+
+        snr_min: float, optional
+            Minimum S/N in the largest aperture of the stars used for
+            the aperture correction. Default = 20
+        """
+        if diameters is None:
+            self.cog = None
+            return
+        if len(self.sizes) < 2:
+            raise ValueError('the curve of growth needs at least two apertures (PHOT_APERTURES)')
+        diameters = np.atleast_1d(np.asarray(diameters, dtype=float))
+        if (diameters < self.sizes[0]).any() or (diameters > self.sizes[-1]).any():
+            print('WARNING! >> apertures outside {}-{} pix are clipped'.format(self.sizes[0], self.sizes[-1]))
+        self.cog = (diameters.tolist(), bool(correct), float(snr_min))
+        print('interpolated apertures (in pixels):', diameters)
+
+    def optimal_apertures(self,target_id=None,comparison=None,PIX_EDGE=30,match_radius=2.,
+                          min_frac=0.9,update=True):
+        """
+        Finds the aperture with the smallest differential photometry
+        scatter for every star of the reference list.
+
+        The fluxes of all the SExtractor apertures (sizes) are collected
+        from the catalogues into a single (epoch x star x aperture)
+        array and the scatter of every star and aperture is computed at
+        once (see opticam_aper.differential_scatter), so no photometry
+        has to be run again for every guess. The scatter of every star
+        and aperture is saved in '<name>_files/<name>_Cx_aperture_scatter.csv'
+
+        target_id: int, optional
+            Identifier of the target. Its best aperture is the one set
+            with set_apertures(). Default = None (the aperture with the
+            smallest median scatter of the comparison stars)
+
+        comparison: list of int, optional
+            Identifiers of the comparison stars. Default = None (all the
+            stars measured in at least `min_frac` of the frames)
+
+        PIX_EDGE: int, optional
+            Detections closer than this to the edges are ignored. Default = 30
+
+        match_radius: float, optional
+            Maximum distance in pixels to the reference star. Default = 2
+
+        update: bool, optional
+            Set the best aperture with set_apertures(). Default = True
+
+        Returns a data frame with the best aperture diameter (in pixels)
+        and its scatter (in mag) of every star
+        """
+        apass = pd.read_csv(self.path_ref_list, comment="#")
+        ids = apass.id.values
+        matcher = PixelMatcher(apass['x'].values, apass['y'].values,
+                               radius=match_radius, one_to_one=True)
+        self.header_index()
+        self.frame_aligner()
+
+        flux = np.full((len(self.flns), ids.size, self.sizes.size), np.nan)
+        for i,flname in enumerate(self.flns):
+            try: data = self._read_catalogue(flname)
+            except: continue
+            naxis1, naxis2 = self._hdr(flname,"NAXIS1"), self._hdr(flname,"NAXIS2")
+            d_x,d_y = self._shift(flname,data)
+            idx, dist, ss = matcher.match(data['X_IMAGE']-d_x, data['Y_IMAGE']-d_y)
+            ss &= (data['X_IMAGE'] > PIX_EDGE) & (data['X_IMAGE'] < naxis1-PIX_EDGE) & \
+                  (data['Y_IMAGE'] > PIX_EDGE) & (data['Y_IMAGE'] < naxis2-PIX_EDGE)
+            flux[i, idx[ss], :] = data['FLUX_APER'][ss]
+
+        target = None if target_id is None else np.argwhere(ids == target_id).T[0]
+        if comparison is None:
+            comp = comparison_stars(flux, min_frac=min_frac, exclude=target)
+        else:
+            comp = np.isin(ids, comparison)
+        print('Aperture scatter of {} stars in {} frames, {} comparison stars'.format(
+              ids.size, len(self.flns), comp.sum()))
+        if comp.sum() == 0:
+            print('WARNING! >> No comparison stars, the apertures are not changed')
+            return None
+        scatter, n = differential_scatter(flux, comp)
+        best = best_aperture(scatter)
+
+        tab = pd.DataFrame(scatter, columns=['scatter_{}'.format(x) for x in self.sizes])
+        tab.insert(0, 'id', ids)
+        tab.insert(1, 'comparison', comp)
+        tab.insert(2, 'n', n.max(axis=1))
+        tab.insert(3, 'best_size', np.where(best >= 0, self.sizes[best], -1))
+        tab.insert(4, 'best_scatter', np.where(best >= 0, scatter[np.arange(ids.size), best], np.nan))
+        tab.to_csv(self.workdir+self.name+'_files/'+self.name+self.marker+'_aperture_scatter.csv', index=False)
+        self.aper_scatter = tab
+
+        if target is not None and target.size > 0 and best[target[0]] >= 0:
+            size = self.sizes[best[target[0]]]
+            print('Best aperture of the target {}: {} pix ({:.4f} mag)'.format(
+                  target_id, size, tab.best_scatter.values[target[0]]))
+        else:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                size = self.sizes[np.nanargmin(np.nanmedian(scatter[comp], axis=0))]
+            print('Best aperture of the comparison stars: {} pix'.format(size))
+        if update:
+            self.set_apertures([size])
+        return tab[['id','comparison','n','best_size','best_scatter']]
         
     def read_sex_param(self,fl_name):
         text = open(fl_name, 'r')
@@ -203,6 +463,8 @@ class Reduction:
         for i,par in enumerate(param):
             default['Values'][default.Variables == par] = values[i]
         np.savetxt(fl_name,default.values,fmt='%s', delimiter='\t')
+        #the catalogues of the new configuration go to another folder
+        self._cfg_key, self.manifest, self.cat_store = None, None, None
         
         if self.vrb: print('default params edited')
             
@@ -219,11 +481,69 @@ class Reduction:
         #np.savetxt(fl_name,default.values,fmt='%s', delimiter='\t')
         return    
     
+    def minimal_param(self,families=None,sizes=None,fl_name='minimal.param'):
+        """
+        Writes a SExtractor parameter file with only the measurements
+        needed by the run and sets it in the config file (through
+        edit_sex_param), so the catalogues are smaller and faster to
+        extract and read. Run it before sextractor().
+
+        Besides the measurement families, the file always has the
+        columns used by the pipeline: NUMBER, X_IMAGE, Y_IMAGE,
+        MAG_ISO, BACKGROUND, THRESHOLD, FWHM_IMAGE and FLAGS.
+
+        families: list of str, optional
+            SExtractor measurements to be saved, any of 'ISO', 'ISOCOR',
+            'AUTO', 'BEST', 'PETRO' and 'APER'. Default = None (the
+            measurement_id and 'APER')
+
+        sizes: array like of int, optional
+            Aperture diameters in pixels (PHOT_APERTURES). At least two
+            apertures are saved (for the curve of growth and the adaptive
+            aperture), a single size gets a second one twice as large.
+            Default = None (the apertures set with set_apertures)
+
+        fl_name: str, optional
+            Name of the parameter file in the working directory.
+            Default = 'minimal.param'
+        """
+        families = self._families([self.measurement_id,'APER'] if families is None else families)
+        if sizes is None:
+            sizes = [self.sizes[ap_ind] for ap_ind in self.aper_ind]
+        sizes = sorted(set(int(x) for x in sizes))
+        if len(sizes) < 2:
+            sizes.append(2*sizes[0])
+            print('WARNING! >> at least two apertures are needed, {} pix added'.format(sizes[-1]))
+
+        lines = ['NUMBER','X_IMAGE','Y_IMAGE','MAG_ISO']
+        for fam in families:
+            n = '({})'.format(len(sizes)) if fam == 'APER' else ''
+            for col in ['MAG_','MAGERR_','FLUX_','FLUXERR_']:
+                if col+fam+n not in lines: lines.append(col+fam+n)
+        lines += ['BACKGROUND','THRESHOLD','FWHM_IMAGE','FLAGS']
+
+        old_sizes = [self.sizes[ap_ind] for ap_ind in self.aper_ind]
+        self._default_files()
+        with open(self.workdir+fl_name,'w') as fl:
+            fl.write('\n'.join(lines)+'\n')
+        self.edit_sex_param(['PARAMETERS_NAME','PHOT_APERTURES'],
+                            [fl_name, ','.join(str(x) for x in sizes)])
+        self.sizes = np.array(sizes)
+        self.aper_ind = [int(np.argwhere(self.sizes==x)[0][0]) for x in old_sizes if x in sizes]
+        if len(self.aper_ind) == 0: self.aper_ind = [0]
+        if self.vrb: print('SExtractor parameters: '+', '.join(lines))
+        return lines
+
 #%%%
     def get_files(self,rule):
-
+        '''
+        Frames of the channel. With cubes=True every FITS cube is
+        replaced by its frames, named 'path[k]' (see opticam_cube)
+        '''
         print('Looking in: ',self.workdir+self.rawdata+rule)
         self.flns = np.sort(glob.glob(self.workdir+self.rawdata+rule))
+        if self.cubes:
+            self.flns = np.array(expand_cubes(self.flns))
 
         if len(self.flns) == 0: 
             print('WARNING! >> No fits files detected')
@@ -233,131 +553,765 @@ class Reduction:
         return self.flns
 
 #%%%
-    def sextractor(self):
+    def header_index(self,n_workers=8,overwrite=False,flns=None,save=True):
         """
-        Routine that uses SExtractor to perform
-        aperture photometry and create a catalogue of 
-        stars for each file.
+        Reads the primary header of every frame once and keeps the
+        keywords used by the pipeline (HEADER_KEYS) in a table indexed
+        by file name. The table is cached in the '<name>_files/' folder
+        and only frames that are new or have a different modification
+        time are read again.
+
+        n_workers: int, optional
+            Number of threads reading the headers. Default = 8
+
+        overwrite: bool, optional
+            Ignore the cached index and read all the headers again
+
+        flns: list, optional
+            Only check these frames, added to the index already loaded
+            (used by stream). Default = None (all the frames)
+
+        save: bool, optional
+            Save the index when it changes. Default = True
         """
-        current_dir = os.getcwd()
-        
-        os.chdir(self.workdir)
-        
-        self.binning = []
-        self.fwhm_image = []
-        self.fwhm_image_pix = []
-        
-        print(os.getcwd())
-        fl_name_conf = self.config_fl_name
+        path = self._headers_path()
+        if not os.path.isdir(self.workdir+self.name+'_files/'):
+            os.makedirs(self.workdir+self.name+'_files/', exist_ok=True)
+
+        flns = self.flns if flns is None else flns
+        names = [fln.split('/')[-1] for fln in flns]
+        mtimes = [os.path.getmtime(frame_path(fln)) for fln in flns]
+
+        if self.headers is not None and not overwrite and flns is not self.flns:
+            old = self.headers
+        elif Path(path).exists() and not overwrite:
+            old = pd.read_pickle(path)
+            #index made before some keyword was added, read again
+            if not set(HEADER_KEYS).issubset(old.columns):
+                old = pd.DataFrame(columns=['mtime']+HEADER_KEYS)
+        else:
+            old = pd.DataFrame(columns=['mtime']+HEADER_KEYS)
+
+        #frames that are not in the index or have been modified
+        todo = [i for i,name in enumerate(names)
+                if name not in old.index or old.at[name,'mtime'] != mtimes[i]]
+
+        if len(todo) > 0:
+            if self.vrb: print('Reading {} headers'.format(len(todo)))
+            with ThreadPoolExecutor(max_workers=n_workers) as pool:
+                values = list(pool.map(_read_header, [flns[i] for i in todo]))
+            new = pd.DataFrame(data=values, columns=HEADER_KEYS, dtype=object,
+                               index=[names[i] for i in todo])
+            new.insert(0, 'mtime', [mtimes[i] for i in todo])
+            old = old.drop(index=new.index, errors='ignore')
+            old = pd.concat([old, new])
+            if save: old.to_pickle(path)
+
+        self.headers = old
+        return self.headers
+
+    def _headers_path(self):
+        return self.workdir+self.name+'_files/'+self.name+self.marker+'_headers.pkl'
+
+    def _hdr(self,fln,key):
+        """
+        Value of a header keyword of a frame. It is looked up in the
+        header index and only read from the file if the frame (or the
+        keyword) is not indexed. Raises KeyError when the keyword is
+        missing, like fits.getval
+        """
+        name = fln.split('/')[-1]
+        if self.headers is None or name not in self.headers.index \
+                or key not in self.headers.columns:
+            return frame_header(fln)[key]
+        value = self.headers.at[name,key]
+        if value is None or (isinstance(value,float) and np.isnan(value)):
+            raise KeyError("Keyword '{}' not found.".format(key))
+        return value
+
+    def decode_times(self):
+        """
+        Decodes the timestamps of all the frames at once. The time of
+        every frame is taken from GPSTIME, or UT if there is no GPSTIME,
+        or DATE-OBS+UT if that is not a full date, and all of them are
+        converted with a single Time object. The frames of a cube start
+        FRAMEIDX x CADENCE seconds after the time of the cube.
+
+        Sets `times`, a data frame indexed by file name with the MJD of
+        the start (MJD_start) and middle (MJD) of the exposure and the
+        exposure time, and the arrays `mjd` and `exptime` in the order
+        of `flns`
+        """
+        import re
+        if self.headers is None: self.header_index()
+        hdr = self.headers.reindex([fln.split('/')[-1] for fln in self.flns])
+
+        full = re.compile(r'^\d{4}-\d{2}-\d{2}(T\d{2}:\d{2}(:\d{2}(\.\d*)?)?)?$')
+        stamps = []
+        for gps, ut, date in zip(hdr['GPSTIME'].values, hdr['UT'].values, hdr['DATE-OBS'].values):
+            t = gps[:-5] if isinstance(gps,str) else ut
+            t = t.replace(' ', 'T') if isinstance(t,str) else ''
+            #hotfix for new latest software version
+            if not full.match(t): t = '{}T{}'.format(date,ut)
+            stamps.append(t)
+
+        try:
+            mjd = Time(stamps, format='fits', scale='utc').mjd
+        except: #some timestamp can not be decoded, one frame at a time
+            self.times = None
+            mjd = np.array([self._mjd(fln) for fln in self.flns])
+        else:
+            mjd = mjd + self._cube_delay(hdr['FRAMEIDX'].values, hdr['CADENCE'].values)
+        exptime = hdr['EXPOSURE'].values.astype(float)
+
+        self.times = pd.DataFrame(data={'MJD_start': mjd,
+                                        'MJD': mjd + exptime/86400./2.,
+                                        'exptime': exptime}, index=hdr.index)
+        self.mjd = self.times.MJD.values
+        self.exptime = exptime
+        return self.times
+
+    def _mjd(self,fln):
+        """
+        MJD of the start of the exposure of a frame
+        """
+        name = fln.split('/')[-1]
+        if self.times is not None and name in self.times.index:
+            return self.times.at[name,'MJD_start']
+        try: mjd_t = self._hdr(fln,"GPSTIME")[:-5]
+        except: mjd_t = self._hdr(fln,"UT")
+        mjd_t = mjd_t.replace(' ', 'T')
+        try: mjd = Time(mjd_t, format='fits', scale='utc').mjd
+        except: #hotfix for new latest software version 
+            mjd_t =  self._hdr(fln,"DATE-OBS")+'T'+self._hdr(fln,"UT")
+            mjd = Time(mjd_t, format='fits', scale='utc').mjd
+        if split_id(fln)[1] is not None:
+            mjd += self._cube_delay(self._hdr(fln,'FRAMEIDX'), self._hdr(fln,'CADENCE'))
+        return mjd
+
+    @staticmethod
+    def _cube_delay(index, cadence):
+        '''
+        Time in days from the start of a cube to its frames (0 for the
+        plain frames, without index)
+        '''
+        index = pd.to_numeric(pd.Series(np.atleast_1d(index)), errors='coerce').fillna(0.).values
+        cadence = pd.to_numeric(pd.Series(np.atleast_1d(cadence)), errors='coerce').fillna(0.).values
+        delay = index*cadence/86400.
+        return delay if delay.size > 1 else delay[0]
+
+    def _cat_path(self,fln):
+        '''
+        Path to the SExtractor catalogue of a raw frame, the frame k of
+        a cube has '_f<k>' after the name of the cube
+        '''
+        fln, k = split_id(fln.split('/')[-1])
+        tag = '' if k is None else '_f{:05d}'.format(k)
+        if fln[-4:] == "fits":
+            cat_fln = fln.split(".fits")[0]+tag+"_cat.fits"
+        else:
+            cat_fln = fln.split(".fit")[0]+tag+"_cat.fits"
+        return self._cat_dir()+cat_fln
+
+    def _cat_dir(self):
+        '''
+        Folder of the catalogues, one per SExtractor configuration with
+        config_cache
+        '''
+        if not self.config_cache:
+            return self.workdir+self.catalogue
+        return self.workdir+self.catalogue+'cfg_'+self._config_key()+'/'
+
+    def _config_files(self):
+        '''
+        Files of the effective SExtractor configuration: the config
+        file and the parameter, filter and neural network files it uses
+        '''
+        flns = [self.workdir+self.config_fl_name]
+        try:
+            conf = self.read_sex_param(flns[0])
+            for key in ['PARAMETERS_NAME','FILTER_NAME','STARNNW_NAME']:
+                value = conf.Values[conf.Variables == key].values
+                if len(value) > 0: flns.append(self.workdir+value[0].split('#')[0].strip())
+        except: pass
+        return [fln for fln in flns if os.path.isfile(fln)]
+
+    def _config_key(self):
+        '''
+        Hash of the SExtractor configuration: the values of the config
+        file (not its comments or layout, which edit_sex_param changes)
+        and the contents of the other files
+        '''
+        if self._cfg_key is None:
+            self._default_files()
+            flns = self._config_files()
+            conf = self.read_sex_param(flns[0])
+            values = sorted('{}={}'.format(var.strip(), val.split('#')[0].strip())
+                            for var,val in zip(conf.Variables, conf.Values)
+                            if var.strip() != 'CATALOG_NAME')
+            sha = hashlib.sha1('\n'.join(values).encode())
+            for fln in flns[1:]:
+                with open(fln,'rb') as fl:
+                    sha.update(fln.split('/')[-1].encode()+b'\0'+fl.read())
+            self._cfg_key = sha.hexdigest()[:12]
+        return self._cfg_key
+
+    def _frame_key(self,fln):
+        '''
+        Signature of the inputs of the catalogue of a raw frame: its
+        name, size and modification time, and those of the master
+        calibration frames applied to it
+        '''
+        flns = [fln]
+        if self.calib is not None:
+            flns += sorted(path for paths in self.calib.masters.values() for path in paths.values())
+        sha = hashlib.sha1()
+        for f in flns:
+            st = os.stat(frame_path(f))
+            sha.update('{}:{}:{};'.format(f.split('/')[-1], st.st_size, st.st_mtime_ns).encode())
+        return sha.hexdigest()[:16]
+
+    def _read_manifest(self):
+        '''
+        Signatures of the raw frames of the catalogues in the folder of
+        the configuration, '<catalogue>/cfg_<hash>/manifest_Cx.csv'
+        '''
+        path = self._cat_dir()+'manifest'+self.marker+'.csv'
+        self.manifest = {}
+        if Path(path).exists():
+            tab = pd.read_csv(path, dtype=str)
+            self.manifest = dict(zip(tab.flname, tab.key))
+        return self.manifest
+
+    def _write_manifest(self):
+        path = self._cat_dir()+'manifest'+self.marker+'.csv'
+        tab = pd.DataFrame(data={'flname': list(self.manifest.keys()),
+                                 'key': list(self.manifest.values())})
+        tab.to_csv(path+'.tmp', index=False)
+        os.replace(path+'.tmp', path)
+
+    def _cat_fresh(self,fln):
+        '''
+        True if the catalogue of a frame exists and, with config_cache,
+        was extracted from the same raw frame. With calibration() the
+        catalogue must also be newer than the frame and its masters
+        '''
+        cat_fln = self._cat_path(fln)
+        if not os.path.isfile(cat_fln):
+            return False
+        #catalogues of other apertures (e.g. before minimal_param) are extracted again
+        width = self._aper_width(cat_fln)
+        if width is not None and width != len(self.sizes):
+            return False
+        if not self.config_cache:
+            if self.calib is None:
+                return True
+            paths = [frame_path(fln)] + [path for paths in self.calib.masters.values()
+                                         for path in paths.values()]
+            return os.path.getmtime(cat_fln) >= max(os.path.getmtime(path) for path in paths)
+        if self.manifest is None: self._read_manifest()
+        return self.manifest.get(fln.split('/')[-1]) == self._frame_key(fln)
+
+    def _default_files(self):
+        '''
+        Copies the default SExtractor files to the working directory
+        (if there is no config file yet)
+        '''
+        fl_name_conf = self.workdir+self.config_fl_name
         if not Path(fl_name_conf).exists():
             sext_def= self._ROOT+'/sextractor_defaults/*'
             os.system('cp '+sext_def+' '+self.workdir)
             if self.vrb:
-                print('generating default sextractor files') 
+                print('generating default sextractor files')
         else:
             if self.vrb: print('using existing sextractor files')
-                
-        if not os.path.isdir(self.catalogue):
-            os.system('mkdir -p '+self.catalogue)
-
-        for i,fln in enumerate(np.sort(glob.glob(self.rawdata+self.rule))):
-            if fln[-4:] == "fits":
-                cat_fln = fln.split(".fits")[0]+"_cat.fits"
-            elif fln[-3:] == "fit":
-                cat_fln = fln.split(".fit")[0]+"_cat.fits"
-            exists = os.path.isfile(self.catalogue+ \
-                    (cat_fln).split("/")[-1])
-            
-            if not exists:
-                os.system("rm temp_sextractor_file.fits")
-
-                hdul = fits.open(fln)
-                #hotfix for broken files
-                try: hdu1 = fits.PrimaryHDU(data=hdul[0].data)
-                except: continue
-                hdu1.header = hdul[0].header
-                new_hdul = fits.HDUList([hdu1])
-                new_hdul.writeto('temp_sextractor_file.fits', overwrite=True)
-
-                hdul.close()
-                os.system("chmod 777 temp_sextractor_file.fits")
-                try:
-                    gain = fits.getval(fln,"GAIN",0)
-                except:
-                    gain = 1.0
-                    
-                try:
-                    self.binning.append(fits.getval(fln,"BINNING",0))
-                    bnn = float(self.binning[-1].split('x')[0])
-                except:
-                    bnn = 1.
-                    print("WARNING: BINNING NOT FOUND")
-
-                sex_out = "sextractor temp_sextractor_file.fits  -c "+self.config_fl_name+" -CATALOG_NAME "+ \
-                          cat_fln+" -GAIN "+str(gain)
-                os.system(sex_out)
-                print(cat_fln)
-                
-                #saving the estimated fwhm of the image
-                msk = np.argwhere(fits.getdata(cat_fln).FWHM_IMAGE >0 ).T[0]
-                PSF_FWHM_pix = np.median(fits.getdata(cat_fln).FWHM_IMAGE[msk])
-                PSF_FWHM = PSF_FWHM_pix*self.ccd_pixscale * bnn
-                
+
+    def _sextractor_files(self):
+        '''
+        Copies the default SExtractor files to the working directory
+        (see _default_files) and creates the catalogue folder. The
+        folder is written in '<name>_files/<name>_Cx_catalogue.txt',
+        where Analysis finds it
+        '''
+        self._default_files()
+        cat_dir = self._cat_dir()
+        if not os.path.isdir(cat_dir):
+            os.system('mkdir -p '+cat_dir)
+        if self.config_cache:
+            #copy of the configuration next to its catalogues
+            for fln in self._config_files():
+                if not os.path.isfile(cat_dir+fln.split('/')[-1]):
+                    shutil.copy(fln, cat_dir)
+        os.makedirs(self.workdir+self.name+'_files/', exist_ok=True)
+        with open(self.workdir+self.name+'_files/'+self.name+self.marker+'_catalogue.txt','w') as fl:
+            fl.write(cat_dir[len(self.workdir):])
+
+    def catalogue_store(self,n_workers=8,overwrite=False):
+        """
+        Ingests the SExtractor catalogues of all the frames into a
+        columnar store ('<catalogue>/store_Cx/') that is read with
+        memory-mapping. Only new or modified catalogues are read.
+        Once the store exists, photometry(), movie() and creat_ref_list()
+        read the catalogues from it.
+
+        n_workers: int, optional
+            Number of threads reading the catalogues. Default = 8
+
+        overwrite: bool, optional
+            Ingest all the catalogues again
+        """
+        self.cat_store = CatalogueStore(self._cat_dir()+'store'+self.marker+'/')
+        self.cat_store.ingest([self._cat_path(fln) for fln in self.flns],
+                              n_workers=n_workers, overwrite=overwrite)
+        if self.vrb: print('{} catalogues in the store'.format(len(self.cat_store)))
+        return self.cat_store
+
+    def _read_catalogue(self,fln):
+        """
+        Catalogue of a raw frame, from the catalogue store when it is
+        available and up to date, from the SExtractor file otherwise.
+
+        The aperture columns always have one column per aperture, also
+        with a single aperture (saved by SExtractor as a scalar). Raises
+        ValueError if the catalogue has a different number of apertures
+        than `sizes` (extracted with another PHOT_APERTURES)
+        """
+        cat_fln = self._cat_path(fln)
+        data = self.cat_store.get(cat_fln) if self.cat_store is not None else None
+        if data is None:
+            data = fits.getdata(cat_fln)
+        if 'FLUX_APER' not in data.names:
+            return data
+        if np.ndim(data['FLUX_APER']) == 1:
+            data = CatalogueFrame({col: np.reshape(data[col], (-1,1)) if col.endswith('_APER')
+                                   else data[col] for col in data.names})
+        if data['FLUX_APER'].shape[1] != len(self.sizes):
+            raise ValueError('{} has {} apertures but PHOT_APERTURES has {}, run sextractor() '
+                             'again'.format(cat_fln, data['FLUX_APER'].shape[1], len(self.sizes)))
+        return data
+
+    def _aper_width(self,cat_fln):
+        """
+        Number of apertures of a SExtractor catalogue, from its header.
+        None if it has no FLUX_APER
+        """
+        with fits.open(cat_fln) as hdul:
+            for hdu in hdul[1:]:
+                if isinstance(hdu, fits.BinTableHDU) and 'FLUX_APER' in hdu.columns.names:
+                    return int(hdu.columns['FLUX_APER'].format.repeat)
+        return None
+
+    def preview_cache(self):
+        """
+        Cache of the stretched and downsampled images of the frames,
+        in '<name>_files/previews_Cx/'. Used by creat_ref_list() and
+        movie(), and for quick looks:
+
+        img, vmin, vmax = op.preview_cache().get(op.flns[0], downscale=4)
+        """
+        return PreviewCache(self.workdir+self.name+'_files/previews'+self.marker+'/')
+
+    def frame_aligner(self,tolerance=5.,radius=2.):
+        """
+        Alignment engine of the night, all the frames are aligned to
+        the reference frame (the frame of the reference star list, see
+        creat_ref_list). The transforms of every frame are saved in
+        '<name>_files/<name>_Cx_transforms.csv' and reused by movie()
+        and photometry().
+
+        tolerance: float, optional
+            Search radius in pixels around the predicted shift. Default = 5
+
+        radius: float, optional
+            Maximum distance in pixels of a confirmed match. Default = 2
+        """
+        ref = self._ref_frame()
+        data = self._read_catalogue(ref)
+        c_ref = np.array([data['X_IMAGE'],data['Y_IMAGE']]).T
+        self.aligner = FrameAligner(c_ref, ref,
+                                    path=self.workdir+self.name+'_files/'+self.name+self.marker+'_transforms.csv',
+                                    tolerance=tolerance, radius=radius)
+        self._ref_window = self._window(ref)
+        return self.aligner
+
+    def _shift(self,fln,data=None):
+        """
+        Shift (dx, dy) of a frame with respect to the reference frame.
+        The catalogue is only read if the transform is not cached.
+
+        The positions of windowed (ROI) frames are moved to the window
+        of the reference frame before they are aligned, and the shift
+        returned is in the pixels of each frame
+        """
+        cat_fln = self._cat_path(fln)
+        mtime = os.path.getmtime(cat_fln) if os.path.isfile(cat_fln) else None
+        delta = self._window(fln) - self._ref_window
+        if data is None and self.aligner.cached(fln, mtime):
+            dx, dy = self.aligner.align(fln, np.zeros((0,2)), mtime)
+        else:
+            if data is None: data = self._read_catalogue(fln)
+            c_tar = np.array([data['X_IMAGE'],data['Y_IMAGE']]).T + delta
+            dx, dy = self.aligner.align(fln, c_tar, mtime)
+        return dx - delta[0], dy - delta[1]
+
+    def _window(self,fln):
+        '''
+        Offset (x0, y0) of the readout window of a frame in the detector,
+        see opticam_cube.window_offset
+        '''
+        try: return np.array([float(self._hdr(fln,'XWINOFF')), float(self._hdr(fln,'YWINOFF'))])
+        except: return np.zeros(2)
+
+#%%%
+    def calibration(self,bias=None,dark=None,flat=None,max_memory=512,overwrite=False):
+        """
+        Builds the master bias, dark and flat frames of the channel (see
+        Calibration), from the frames in the folders `bias`, `dark` and
+        `flat` (inside workdir) that follow `rule`. The masters are saved
+        in 'calibration/' and applied by sextractor() and stream() to the
+        frames without a catalogue.
+
+        max_memory: float, optional
+            Memory in MB used by the frames being combined. Default = 512
+
+        overwrite: bool, optional
+            Build the masters again even if they are up to date
+        """
+        self.calib = Calibration(workdir=self.workdir, bias=bias, dark=dark, flat=flat,
+                                 rule=self.rule, vrb=self.vrb)
+        self.calib.build(max_memory=max_memory, overwrite=overwrite)
+        return self.calib
+
+    def _warn_uncalibrated(self,flns):
+        '''
+        A single warning with the frames that have no master calibration
+        frames for their binning, see calibration()
+        '''
+        if self.calib is None or len(flns) == 0:
+            return
+        self.header_index(flns=flns, save=False)
+        hdr = self.headers.reindex([fln.split('/')[-1] for fln in flns])
+        headers = [{key: value for key,value in rec.items() if value is not None and value == value}
+                   for rec in hdr.to_dict('records')]
+        for bnn, n in uncalibrated(headers, self.calib.masters).items():
+            print('WARNING: no calibration frames for binning {}, {} frames not calibrated'.format(bnn, n))
+
+    def sextractor(self,n_workers=1,executor=None):
+        """
+        Routine that uses SExtractor to perform
+        aperture photometry and create a catalogue of
+        stars for each file.
+
+        n_workers: int, optional
+            Number of frames extracted at the same time. Each worker
+            process uses its own scratch directory and temporary file.
+            Default = 1 (one frame at a time)
+
+        executor: concurrent.futures executor, optional
+            Pool shared with other reductions (see MultiReduction),
+            n_workers is ignored when it is given. Default = None
+        """
+        workdir = os.path.abspath(self.workdir)
+
+        self.binning = []
+        self.fwhm_image = []
+        self.fwhm_image_pix = []
+
+        print(workdir)
+        self._cfg_key = None
+        self._sextractor_files()
+        if self.config_cache:
+            self._read_manifest()
+            print('Catalogues in '+self._cat_dir())
+
+        scratch = os.path.join(workdir, 'sextractor_tmp'+self.marker)
+        flns = np.sort(glob.glob(self.workdir+self.rawdata+self.rule))
+        if self.cubes: flns = np.array(expand_cubes(flns))
+
+        todo = []
+        for i,fln in enumerate(flns):
+            cat_fln = self._cat_path(fln)
+            if not self._cat_fresh(fln):
+                todo.append((i, fln, os.path.abspath(cat_fln)))
+            else:
+                print("{:4.0f} / {:4.0f} -- It exists!".format(i+1,len(flns)))
+
+        masters = self.calib.masters if self.calib is not None else None
+        self._warn_uncalibrated([fln for i,fln,cat_fln in todo])
+        args = [(os.path.abspath(fln), cat_fln, self.config_fl_name, workdir,
+                 scratch, self.ccd_pixscale, masters) for i,fln,cat_fln in todo]
+
+        #the shared executor is left open, an own pool is shut down on exit
+        if executor is not None:
+            context = nullcontext(executor)
+        elif n_workers > 1 and len(todo) > 1:
+            context = ProcessPoolExecutor(max_workers=n_workers)
+        else:
+            context = nullcontext(None)
+
+        with context as pool:
+            if pool is not None:
+                results = [pool.submit(_sextractor_frame, *arg) for arg in args]
+            else:
+                results = (_sextractor_frame(*arg) for arg in args)
+
+            #results are collected in frame order
+            for (i,fln,cat_fln), res in zip(todo, results):
+                if pool is not None:
+                    res = res.result()
+                if res is None: continue
+                if self.config_cache:
+                    self.manifest[fln.split('/')[-1]] = self._frame_key(fln)
+
+                binning, PSF_FWHM, PSF_FWHM_pix = res
+                if binning is not None:
+                    self.binning.append(binning)
                 self.fwhm_image.append(PSF_FWHM)
                 self.fwhm_image_pix.append(PSF_FWHM_pix)
-                ###
-                
-                #moving the cat file 
-                print("mv "+cat_fln+\
-                            " "+self.catalogue+".")
-                os.system("mv "+cat_fln+\
-                             " "+self.catalogue+".")
 
-                print("{:4.0f} / {:4.0f} -- {}".format(i+1,len(self.flns),fln))
-                
-                
-                
-            else:
-                print("{:4.0f} / {:4.0f} -- It exists!".format(i+1,len(self.flns)))
-                
-        os.chdir(current_dir)
+                print(cat_fln)
+                print("{:4.0f} / {:4.0f} -- {}".format(i+1,len(flns),fln))
+
+        shutil.rmtree(scratch, ignore_errors=True)
+        if self.config_cache and len(todo) > 0:
+            self._write_manifest()
 
 #%%
-    def creat_ref_list(self,number=0):
+    def frame_stats(self,PIX_EDGE=30):
+        """
+        Statistics of the catalogue of every frame, computed from the
+        catalogue store in a single pass over its columns: number of
+        sources (n_src), clean sources (n_good: FLAGS = 0, valid FWHM
+        and magnitude, away from the edges), median FWHM_IMAGE and
+        BACKGROUND of the clean sources and fraction of flagged sources.
+        Saved in '<name>_files/<name>_Cx_frame_stats.csv'
+
+        If the catalogue store was not built yet, it is built here (see
+        catalogue_store), ingesting all the catalogues into store_Cx
+
+        PIX_EDGE: int, optional
+            Sources closer than this to the edges are not clean. Default = 30
+        """
+        store = self.cat_store if self.cat_store is not None else self.catalogue_store()
+        self.header_index()
+        names = [fln.split('/')[-1] for fln in self.flns]
+        index = store.index.reindex([self._cat_path(fln).split('/')[-1] for fln in self.flns])
+        index.index = names
+        naxis1 = self.headers.reindex(names).NAXIS1.values.astype(float)
+        naxis2 = self.headers.reindex(names).NAXIS2.values.astype(float)
+        pos = pd.Index(names)
+
+        stats = []
+        for shard, grp in index.dropna().groupby('shard'):
+            cols = store._shard(int(shard))
+            frame = pos.get_indexer(grp.index)
+            start, stop = grp.start.values.astype(int), grp.stop.values.astype(int)
+            rows = np.concatenate([np.arange(a,b) for a,b in zip(start,stop)])
+            code = np.repeat(frame, stop-start)
+
+            n = rows.size
+            x, y = cols['X_IMAGE'][rows], cols['Y_IMAGE'][rows]
+            flags = cols['FLAGS'][rows] if 'FLAGS' in cols else np.zeros(n, dtype=int)
+            fwhm = cols['FWHM_IMAGE'][rows] if 'FWHM_IMAGE' in cols else np.full(n, np.nan)
+            bkg = cols['BACKGROUND'][rows] if 'BACKGROUND' in cols else np.full(n, np.nan)
+            mag = cols['MAG_ISO'][rows] if 'MAG_ISO' in cols else np.zeros(n)
+            good = (flags == 0) & (fwhm > 0) & np.isfinite(mag) & (mag < 99) & \
+                   (x > PIX_EDGE) & (x < naxis1[code]-PIX_EDGE) & \
+                   (y > PIX_EDGE) & (y < naxis2[code]-PIX_EDGE)
+
+            tab = pd.DataFrame(data={'frame': code, 'good': good, 'flagged': flags > 0,
+                                     'fwhm': np.where(good, fwhm, np.nan),
+                                     'background': np.where(good, bkg, np.nan)})
+            g = tab.groupby('frame')
+            stats.append(pd.DataFrame(data={'n_src': g.size(), 'n_good': g.good.sum(),
+                                            'fwhm': g.fwhm.median(),
+                                            'background': g.background.median(),
+                                            'flagged': g.flagged.mean()}))
+
+        stats = pd.concat(stats) if len(stats) > 0 else pd.DataFrame(columns=['n_src','n_good','fwhm','background','flagged'])
+        stats = stats.reindex(np.arange(len(names)))
+        stats.insert(0, 'flname', names)
+        stats.to_csv(self.workdir+self.name+'_files/'+self.name+self.marker+'_frame_stats.csv', index=False)
+        self.stats = stats
+        return stats
+
+    def select_reference(self,frac=0.9):
+        """
+        Chooses the reference frame from the catalogue statistics (see
+        frame_stats): among the frames with at least `frac` times the
+        largest number of clean sources, the one with the smallest
+        median FWHM, and then the lowest background.
+
+        Returns the index of the frame in `flns`, also set as `ref_number`.
+        It builds the catalogue store if needed, see frame_stats
+        """
+        stats = self.frame_stats()
+        n_good = stats.n_good.fillna(0).values
+        cand = stats[n_good >= frac*n_good.max()]
+        cand = cand.sort_values(['fwhm','background'], na_position='last')
+        self.ref_number = int(cand.index[0])
+        print('Reference frame: {} ({:.0f} clean sources, FWHM = {:.2f} pix)'.format(
+              cand.flname.iloc[0], cand.n_good.iloc[0], cand.fwhm.iloc[0]))
+        return self.ref_number
+
+    def quality_control(self,PIX_EDGE=30,min_sources=0.5,max_fwhm=2.,max_background=3.,
+                        max_flagged=0.5,max_residual=1.,min_match=3):
+        """
+        Quality control of every frame: the catalogue statistics (see
+        frame_stats) together with the alignment of the frame (method,
+        number of matched stars and residual, see frame_aligner), and a
+        set of rules to reject the bad frames. The table is saved in
+        '<name>_files/<name>_Cx_frame_qc.csv' and the rejected frames
+        are skipped by photometry() and Analysis.
+
+        min_sources: float, optional
+            Minimum number of clean sources, as a fraction of the median
+            of the night. Default = 0.5
+
+        max_fwhm: float, optional
+            Maximum FWHM, in units of the median of the night. Default = 2
+
+        max_background: float, optional
+            Maximum background, in units of the median of the night.
+            Default = 3
+
+        max_flagged: float, optional
+            Maximum fraction of flagged sources. Default = 0.5
+
+        max_residual: float, optional
+            Maximum median residual of the alignment in pixels. Default = 1
+
+        min_match: int, optional
+            Minimum number of stars matched in the alignment. Default = 3
+
+        Any rule set to None is not applied. Frames without catalogue or
+        whose alignment failed are always rejected.
+        """
+        qc = self.frame_stats(PIX_EDGE=PIX_EDGE)
+        self.frame_aligner()
+        align = []
+        for fln,n_src in zip(self.flns, qc.n_src.values):
+            if not np.isfinite(n_src):
+                align.append((None, 0, np.nan))
+                continue
+            self._shift(fln)
+            entry = self.aligner.cache[fln.split('/')[-1]]
+            align.append((entry['method'], entry['nmatch'], entry['residual']))
+        qc['method'], qc['nmatch'], qc['residual'] = [list(col) for col in zip(*align)]
+
+        median = qc[['n_good','fwhm','background']].median()
+        rules = [('no catalogue', qc.n_src.isnull()),
+                 ('alignment failed', qc.method == 'failed')]
+        if min_sources is not None:
+            rules.append(('few sources', qc.n_good < min_sources*median.n_good))
+        if max_fwhm is not None:
+            rules.append(('fwhm', qc.fwhm > max_fwhm*median.fwhm))
+        if max_background is not None:
+            rules.append(('background', qc.background > max_background*median.background))
+        if max_flagged is not None:
+            rules.append(('flagged', qc.flagged > max_flagged))
+        if max_residual is not None:
+            rules.append(('residual', qc.residual > max_residual))
+        if min_match is not None:
+            rules.append(('few matches', (qc.nmatch < min_match) & (qc.method != 'reference')))
+
+        reason = [[] for i in range(len(qc))]
+        for label, mask in rules:
+            for i in np.argwhere(mask.values).T[0]:
+                reason[i].append(label)
+        qc['rejected'] = [len(r) > 0 for r in reason]
+        qc['reason'] = [';'.join(r) for r in reason]
+
+        qc.to_csv(self.workdir+self.name+'_files/'+self.name+self.marker+'_frame_qc.csv', index=False)
+        self.qc = qc
+        print('Quality control: {} / {} frames rejected'.format(qc.rejected.sum(), len(qc)))
+        if self.vrb:
+            for name, why in zip(qc.flname[qc.rejected], qc.reason[qc.rejected]):
+                print('  {} : {}'.format(name, why))
+        return qc
+
+    def _rejected(self):
+        """
+        Names of the frames rejected by quality_control(), from the
+        saved table if it was not run in this session
+        """
+        qc = self.qc
+        path = self.workdir+self.name+'_files/'+self.name+self.marker+'_frame_qc.csv'
+        if qc is None and Path(path).exists():
+            qc = pd.read_csv(path)
+        if qc is None:
+            return set()
+        return set(qc.flname[qc.rejected.astype(bool)])
+
+    def _ref_frame(self):
+        """
+        Reference frame of the night: the frame of the reference star
+        list, which is also the alignment anchor
+        """
+        if getattr(self,'path_to_ref_fits',None) is not None:
+            return self.path_to_ref_fits
+        path = self.workdir+self.name+'_files/'+self.name+self.marker+'_ref_frame.txt'
+        if Path(path).exists():
+            with open(path) as fl:
+                return self.workdir+self.rawdata+fl.read().strip()
+        return self.flns[0]
+
+    def creat_ref_list(self,number=None,downscale=1):
         '''
         Create reference star list
 
-        number :: Default. First image of the list
+        number :: index of the reference image. Default = None, the
+                  image is chosen with select_reference(), which ingests
+                  all the catalogues into the catalogue store (store_Cx,
+                  see catalogue_store) if it does not exist yet
+
+        downscale :: binning factor of the image in the plot, the image
+                     is taken from the preview cache. Default = 1
         '''
         if not os.path.isdir(self.workdir+self.name+'_files/'):
             os.system('mkdir '+self.workdir+self.name+'_files/')
-        fln = self.flns[number].split('/')[-1]
+        if number is None:
+            number = self.select_reference()
+        fl2 = self._set_ref_frame(number)
 
-#        print(fln)
-        if fln[-3:] == 'its':
-            fl1 = self.workdir+self.catalogue+fln.split(".fits")[0]+"_cat.fits"
-        else:
-            fl1 = self.workdir+self.catalogue+fln.split(".fit")[0]+"_cat.fits"
+        data = self._read_catalogue(fl2)
+        self._write_ref_list(fl2, data, downscale)
 
-        fl2 = self.workdir+self.rawdata+fln
-        #print(fl1)
-
-        data = fits.getdata(fl1)
+    def _set_ref_frame(self,number):
+        """
+        Sets the reference frame, also the alignment anchor, and saves
+        its name in '<name>_files/<name>_Cx_ref_frame.txt'
+        """
+        self.ref_number = number
+        fln = self.flns[number].split('/')[-1]
+        with open(self.workdir+self.name+'_files/'+self.name+self.marker+'_ref_frame.txt','w') as fl:
+            fl.write(fln+'\n')
+        self.path_to_ref_fits = self.workdir+self.rawdata+fln
+        return self.path_to_ref_fits
 
-        #print(data.columns)
-        self.path_to_ref_fits = fl2
+    def _write_ref_list(self,fl2,data,downscale=1):
+        """
+        Plots the field with the sources of the catalogue `data` of the
+        image `fl2` and saves them as the reference star list
+        """
+        #log stretched image, pmin=40, pmax=99
+        img = self.preview_cache().get(fl2,downscale=downscale)[0]
+        ny, nx = img.shape[0]*downscale, img.shape[1]*downscale
 
         fig = plt.figure(figsize=(14,14))
-        gc = aplpy.FITSFigure(fl2,hdu=0,figure=fig)
-        gc.show_grayscale(pmin=40,pmax=99,stretch="log",invert=True)
-
-        gc.show_circles(data['X_IMAGE'], data['Y_IMAGE'], radius=13,color='g',lw=3)
+        ax = fig.add_subplot(111)
+        ax.imshow(img,origin='lower',cmap='gray',vmin=0,vmax=GREYS-1,
+                  extent=[0.5,nx+0.5,0.5,ny+0.5],interpolation='nearest')
 
         for i in range(data['X_IMAGE'].size):
+            ax.add_patch(plt.Circle((data['X_IMAGE'][i], data['Y_IMAGE'][i]), 13,
+                                    fill=False, color='g', lw=3))
             plt.text(data['X_IMAGE'][i]+10, data['Y_IMAGE'][i]+10,data['NUMBER'][i],fontsize=15,color='blue')
+        ax.set_xlabel('x (pix)')
+        ax.set_ylabel('y (pix)')
         
         plt.show()
-        gc.savefig(self.workdir+self.name+'_files/'+self.name+self.marker+'_fov.pdf')
+        fig.savefig(self.workdir+self.name+'_files/'+self.name+self.marker+'_fov.pdf')
         df = pd.DataFrame(data=np.array([data['NUMBER'],
                                 data['X_IMAGE'],
                                 data['Y_IMAGE']]).T,columns=["id", "x","y"])
@@ -367,6 +1321,88 @@ class Reduction:
 
         self.ref_stars = df
 
+    def stack(self,n_frames=20,frames=None,method='median',sigma=3.,max_memory=512,downscale=1):
+        """
+        Deep reference image: stacks the frames into the geometry of the
+        reference frame (see creat_ref_list), runs SExtractor over it and
+        saves its sources as the reference star list, so faint comparison
+        stars are also measured by photometry().
+
+        The frames are shifted by whole pixels using their transforms
+        (see frame_aligner) and combined tile by tile from the memory-
+        mapped files (see opticam_stack.stack_frames), so the memory is
+        bounded by `max_memory` whatever the number of frames.
+
+        n_frames: int, optional
+            Number of frames stacked, the ones with more clean sources and
+            better seeing (see frame_stats). Default = 20
+
+        frames: list of int, optional
+            Indices of the frames to be stacked, instead of n_frames
+
+        method: str, optional
+            'median' or 'mean' (sigma-clipped mean). Default = 'median'
+
+        sigma: float, optional
+            Clipping threshold of the mean. Default = 3
+
+        max_memory: float, optional
+            Memory in MB used by the frames being combined. Default = 512
+
+        downscale: int, optional
+            Binning factor of the image in the field plot. Default = 1
+        """
+        if not os.path.isdir(self.workdir+self.name+'_files/'):
+            os.makedirs(self.workdir+self.name+'_files/', exist_ok=True)
+        self.header_index()
+        if not Path(self.workdir+self.name+'_files/'+self.name+self.marker+'_ref_frame.txt').exists() \
+                and getattr(self,'path_to_ref_fits',None) is None:
+            self._set_ref_frame(self.select_reference())
+        ref = self._ref_frame()
+
+        if frames is None:
+            stats = self.frame_stats()
+            frames = stats.sort_values(['n_good','fwhm'], ascending=[False,True]).index[:n_frames]
+        flns = [self.flns[k] for k in sorted(frames)]
+
+        #whole-pixel shifts and exposure time normalisation to the reference frame
+        self.frame_aligner()
+        shifts = [self._shift(fln) for fln in flns]
+        exptime = np.array([self._hdr(fln,"EXPOSURE") for fln in flns], dtype=float)
+        scale = self._hdr(ref,"EXPOSURE")/exptime
+        shape = (self._hdr(ref,"NAXIS2"), self._hdr(ref,"NAXIS1"))
+
+        print('Stacking {} frames ({})'.format(len(flns),method))
+        image, count = stack_frames(flns, shifts, shape, scale=scale, method=method,
+                                    sigma=sigma, max_memory=max_memory, vrb=self.vrb)
+        image[~np.isfinite(image)] = np.nanmedian(image)
+
+        header = frame_header(ref)
+        header['NCOMBINE'] = (len(flns), 'Number of frames stacked')
+        header['STACKMOD'] = (method, 'Combination of the frames')
+        #the noise of the stack is reduced as if the gain was larger
+        gain = header.get('GAIN', 1.0) * len(flns) * (2./np.pi if method == 'median' else 1.)
+        header['GAIN'] = gain
+        for fln in flns:
+            header.add_history('STACK '+fln.split('/')[-1])
+        stack_fln = self.workdir+self.name+'_files/'+self.name+self.marker+'_stack.fits'
+        fits.HDUList([fits.PrimaryHDU(data=image, header=header),
+                      fits.ImageHDU(data=count, name='NCOMBINE')]).writeto(stack_fln, overwrite=True)
+
+        #deep source list
+        self._sextractor_files()
+        workdir = os.path.abspath(self.workdir)
+        cat_fln = os.path.abspath(self.workdir+self.name+'_files/'+self.name+self.marker+'_stack_cat.fits')
+        res = _sextractor_frame(os.path.abspath(stack_fln), cat_fln, self.config_fl_name, workdir,
+                                os.path.join(workdir,'sextractor_tmp'+self.marker), self.ccd_pixscale)
+        shutil.rmtree(os.path.join(workdir,'sextractor_tmp'+self.marker), ignore_errors=True)
+        if res is None:
+            raise RuntimeError('SExtractor failed on the stack '+stack_fln)
+
+        self._write_ref_list(stack_fln, fits.getdata(cat_fln), downscale)
+        print('Reference star list from the stack of {} frames: {} sources'.format(len(flns),len(self.ref_stars)))
+        return stack_fln
+
 #%%
     def get_position(self,num):
 
@@ -380,246 +1416,510 @@ class Reduction:
 
 #%%
 
-    def movie(self,target_id=None,clean_tmp=True):
+    def movie(self,target_id=None,clean_tmp=None,match_radius=2.,one_to_one=False,
+              step=1,downscale=1,n_workers=4,fps=5):
         """
         Create a movie with all the images and the target cross matched. 
         This is based in the photometry method.
+
+        The frames are rendered in a pool of processes and written to
+        '<name>_files/<name>_Cx_fov.gif' one at a time, so the memory
+        does not grow with the number of frames.
         
         target_id: index of the target in the reference image
                     
-        clean_tmp: remove all the individual frames. Default = True
+        clean_tmp: deprecated, the frames are no longer saved as images.
+                    Passing it only raises a DeprecationWarning
+
+        match_radius: maximum distance in pixels between a detection and
+                    its reference star. Default = 2
+
+        one_to_one: a reference star can only be matched to one detection.
+                    Default = False
+
+        step: only one every `step` frames is used. Default = 1
+
+        downscale: the images are binned by this factor. Default = 1
+
+        n_workers: number of processes rendering the frames. Default = 4
+
+        fps: frames per second of the movie. Default = 5
         """
-        import gc as mpl
-        self.photo_file = self.name+self.marker+'_photo' #+'_'+self.measurement_id
+        from collections import deque
+        if clean_tmp is not None:
+            warnings.warn('clean_tmp is deprecated and has no effect, the frames are no longer '
+                          'saved as images', DeprecationWarning, stacklevel=2)
         apass = pd.read_csv(self.workdir+self.name+'_files/'+self.name+self.marker+'_ref_stars.csv',
             comment="#")
-        apass.set_index('id')
         
         #if there is no target id we set it to 1 as default
         if not target_id:
             target_id = 1
-                
-
-        vrb = self.vrb 
-        save_output = True
-
 
-        PIX_EDGE = 30
-        
-        coo_apass = SkyCoord(apass['x']/1000.*u.deg, apass['y']/1000*u.deg)
-
-        num_flns = len(self.flns)
+        matcher = PixelMatcher(apass['x'].values, apass['y'].values,
+                               radius=match_radius, one_to_one=one_to_one)
 
-        mov_fl = Path(self.workdir+self.name+'_files/'+self.name+self.marker+'_ref_stars.gif')
+        mov_fl = self.workdir+self.name+'_files/'+self.name+self.marker+'_fov.gif'
         print(mov_fl)
 
-        if mov_fl.exists():
+        if Path(mov_fl).exists():
             print('Video file already exists')
-            check_flag = True
-        else:
-            dd = {'flname': [], 'id_apass': [],'Filter': [],'MJD': [],
-                 'flux': [],'flux_err': [],'mag': [],'mag_err': []
-                 }
-
-            sta = pd.DataFrame(data=dd)
-            df3 = {}
-            id3 = 0
-            check_flag = False
-        
-        if check_flag: 
-            print("File already exist")
             return 
     
         print("OPTICAM - Movie curve generator")
-        
-        ccd_pixscale = self.ccd_pixscale
-        
-
-        
-        for i,flname in enumerate(self.flns[:]):
-            k=i
-            flnt = flname.split('/')[-1]
-            if flnt.split('.')[-1] == 'fits':
-                flnt2 = flnt[:-5]+'_cat.fits'
-            elif flnt.split('.')[-1] == 'fit':
-                flnt2 = flnt[:-4]+'_cat.fits'
-                
-            cat_flname = self.workdir+self.catalogue+flnt2
-            #print(flname,cat_flname)
-            if check_flag :
-                if vrb: print(flname+" exists")
-            else:
-                print("Processing {:5.0f} / {:5.0f} : {}".format(i+1,num_flns,
+        self.header_index()
+        self.decode_times()
+        self.frame_aligner()
+
+        previews = self.preview_cache()
+        flns = self.flns[::step]
+        with GifWriter(mov_fl, fps=fps) as gif, \
+             ProcessPoolExecutor(max_workers=n_workers) as pool:
+            #only a few frames are waiting to be written at any time
+            pending = deque()
+            for k,flname in enumerate(flns):
+                print("Processing {:5.0f} / {:5.0f} : {}".format(k+1,len(flns),
                         flname.split('/')[-1]))
+                args = self._movie_frame(flname,apass,matcher,target_id)
+                if args is None: continue
+                pending.append(pool.submit(render_frame, downscale=downscale,
+                                           cache=previews.path, **args))
+                if len(pending) >= 2*n_workers:
+                    gif.write(pending.popleft().result())
+            while len(pending) > 0:
+                gif.write(pending.popleft().result())
+
+        print('Movie saved in '+mov_fl)
+
+    def cutouts(self,target_id=None,comparison=None,size=31,step=1,animation=True,
+                zoom=4,fps=10,n_workers=8):
+        """
+        Stamps around the target and the comparison stars in every frame.
+        The positions in the reference frame (see get_position) are moved
+        with the shift of every frame (see frame_aligner) and only the
+        pixels of the stamps are read from the memory-mapped images.
 
-                filt = fits.getval(flname,"FILTER",0)
-                #obj = fits.getval(flname,"OBJECT",0)
-                exptime = fits.getval(flname,"EXPOSURE",0)
-                try: mjd_t = fits.getval(flname,"GPSTIME",0)[:-5]
-                except: mjd_t = fits.getval(flname,"UT",0)
-                mjd_t = mjd_t.replace(' ', 'T')
-                #hotfix 
-                try: mjd = Time(mjd_t, format='fits', scale='utc').mjd
-                except: #hotfix for new latest software version 
-                    mjd_t =  fits.getval(flname,"DATE-OBS",0)+'T'+fits.getval(flname,"UT",0)
-                    mjd = Time(mjd_t, format='fits', scale='utc').mjd
-                airmass = fits.getval(flname,"AIRMASS",0)
-                naxis1 = fits.getval(flname,"NAXIS1",0)
-                naxis2 = fits.getval(flname,"NAXIS2",0)
-                try: 
-                    xbin= fits.getval(flname,"CCDXBIN",0)
-                    ybin= fits.getval(flname,"CCDYBIN",0)
-                    if xbin==ybin:
-                        pixscale = ccd_pixscale * xbin
-                    else:
-                        pixscale = ccd_pixscale
-                        print("Warning: different binning per axis")
-                except:
-                    pixscale= ccd_pixscale
-                    print("Warning: Binning not found in the header, FWHM not trustable")
-                   
-                msk = np.argwhere(fits.getdata(cat_flname).FWHM_IMAGE >0 ).T[0]
-                PSF_FWHM = np.median(fits.getdata(cat_flname).FWHM_IMAGE[msk])
-                try:
-                    seeing = fits.getval(flname,"L1FWHM",0)
-                except:
-                    seeing = PSF_FWHM*pixscale
-                if seeing == "UNKNOWN": seeing = PSF_FWHM*pixscale
-                if vrb: print("Seeing = {:7.3f} arcsec".format(seeing))
-                if vrb: print("PSF FWHM = {:7.3f} arcsec".format(PSF_FWHM*pixscale))
-                data = fits.getdata(cat_flname)
+        The stamps of every star are written frame by frame into a cube
+        '<name>_files/stamps_Cx/<name>_Cx_stamps_<id>.fits' (frames x size
+        x size) with a table of the frames (flname, MJD, dx, dy and the
+        centre of the stamp, x, y) in the second extension.
 
+        target_id: id of the target in the reference list. Default = 1
 
-                #### Align images #####
-                d_x,d_y = 0.0,0.0
+        comparison: ids of the comparison stars. Default = None (none)
 
-                if i==0:
-                    c_ref = np.array([data['X_IMAGE'],data['Y_IMAGE']]).T
-                else:
-                    c_tar = np.array([data['X_IMAGE'],data['Y_IMAGE']]).T
-                    try:
-                        p, (pos_img, pos_img_rot) = aa.find_transform(c_ref, c_tar)
-                        d_x,d_y = p.translation[0],p.translation[1]
-                        print("Translation: (x, y) = ({:.2f}, {:.2f})".format(*p.translation))
-                    except: 
-                        print('WARNING! >> List of matching triangles exhausted before an acceptable transformation was found?!?!')
-                    
+        size: side of the stamps in pixels. Default = 31
 
-                coo_image = SkyCoord((data['X_IMAGE']-d_x)/1000*u.deg, 
-                                     (data['Y_IMAGE']-d_y)/1000*u.deg)
+        step: only one every `step` frames is used. Default = 1
 
-                if vrb: print("Filter: {}".format(filt))
+        animation: also save the stamps as '<name>_Cx_stamps.gif', with
+                   the stars side by side. Default = True
 
-                idx_apass, d2d_apass, d3d_apass = coo_image.match_to_catalog_sky(coo_apass) #
+        zoom: enlarging factor of the stamps in the animation. Default = 4
 
-                # Make mask due to separation
-                ss = (d2d_apass.deg*1000 < 2)
-                
-                
-                #print(idx_apass, d2d_apass, d3d_apass)
-                #pass 
-                std_mag = apass['x'][idx_apass]
-                ## %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
-                measurement_id_list = ['ISO', 'ISOCOR', 'APER', 'AUTO', 'BEST', 'PETRO']
-                flux_ISO = []
-                flux_ISO_err = []
-                mag_ISO = []
-                mag_ISO_err = []
-                
-                flux_ISO.append(data['FLUX_ISO']/exptime)
-                flux_ISO_err.append(data['FLUXERR_ISO']/exptime)
-                mag_ISO.append(data['MAG_ISO'] + 2.5 * np.log10(exptime))
-                mag_ISO_err.append(data['MAGERR_ISO'])
-                
-                flux_APER = []
-                flux_APER_err = []
-                mag_APER = []
-                mag_APER_err = []
-                
-                flux_APER.append(data['FLUX_APER']/exptime)
-                flux_APER_err.append(data['FLUXERR_APER']/exptime)
-                mag_APER.append(data['MAG_APER'] + 2.5 * np.log10(exptime))
-                mag_APER_err.append(data['MAGERR_APER'])
-
-                pp = np.isfinite(np.array(mag_ISO)[0][ss]) & \
-                     (data['X_IMAGE'][ss] > PIX_EDGE ) & \
-                     (data['X_IMAGE'][ss] < naxis1 -PIX_EDGE)  & \
-                     (data['Y_IMAGE'][ss] > PIX_EDGE ) & \
-                     (data['Y_IMAGE'][ss] < naxis2 -PIX_EDGE )
-                
+        fps: frames per second of the animation. Default = 10
 
-                #creating individual plots for each image
-                fig = plt.figure(figsize=(14,14))
-                
-                gc = aplpy.FITSFigure(flname,hdu=0,figure=fig,animated=True)
-                gc.show_grayscale(pmin=40,pmax=99,stretch="log",invert=True)
-                
-                
-                x_im, y_im = data['X_IMAGE'][ss][pp]+d_x, data['Y_IMAGE'][ss][pp]+d_y
+        n_workers: number of threads reading the stamps. Default = 8
+        """
+        if not target_id:
+            target_id = 1
+        if comparison is None:
+            comparison = []
+        if not hasattr(self,'ref_stars'):
+            self.ref_stars = pd.read_csv(self.path_ref_list, comment="#")
+        ids = [target_id] + list(comparison)
+        x0, y0 = [], []
+        for num in ids:
+            self.get_position(num)
+            x0.append(self.tar_x)
+            y0.append(self.tar_y)
+        x0, y0 = np.array(x0), np.array(y0)
+
+        self.header_index()
+        self.decode_times()
+        self.frame_aligner()
+
+        flns = self.flns[::step]
+        size = int(size) | 1 #odd, so the star is in the central pixel
+        path = self.workdir+self.name+'_files/stamps'+self.marker+'/'
+        os.makedirs(path, exist_ok=True)
+        cube_flns = [path+self.name+self.marker+'_stamps_{}.fits'.format(int(num)) for num in ids]
+
+        header = fits.Header([('SIMPLE',True),('BITPIX',-32),('NAXIS',3),('NAXIS1',size),
+                              ('NAXIS2',size),('NAXIS3',len(flns)),('EXTEND',True)])
+        cubes = []
+        for num,cube_fln in zip(ids,cube_flns):
+            header['STAR_ID'] = int(num)
+            #StreamingHDU appends to existing files
+            if os.path.isfile(cube_fln): os.remove(cube_fln)
+            cubes.append(fits.StreamingHDU(cube_fln, header))
+        gif = GifWriter(path+self.name+self.marker+'_stamps.gif', fps=fps) if animation else None
+
+        #centres of the stamps in every frame
+        tab = {'flname': [], 'MJD': [], 'dx': [], 'dy': [], 'x': [], 'y': []}
+        for flname in flns:
+            dx, dy = self._shift(flname)
+            tab['flname'].append(flname.split('/')[-1])
+            tab['MJD'].append(self._mjd(flname) + self._hdr(flname,"EXPOSURE")/86400./2.)
+            tab['dx'].append(dx)
+            tab['dy'].append(dy)
+            tab['x'].append(np.round(x0+dx).astype(int))
+            tab['y'].append(np.round(y0+dy).astype(int))
+
+        #read in chunks, so only a few stamps are in memory at any time
+        chunk = 64*n_workers
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            for c in range(0,len(flns),chunk):
+                stamps = pool.map(read_stamps, flns[c:c+chunk], tab['x'][c:c+chunk],
+                                  tab['y'][c:c+chunk], [size]*len(flns[c:c+chunk]))
+                for st in stamps:
+                    for cube,stamp in zip(cubes,st):
+                        cube.write(stamp[None])
+                    if gif is not None:
+                        gif.write(stamps_frame(st, zoom=zoom))
+                if self.vrb: print('{:7.0f} / {:7.0f} frames'.format(min(c+chunk,len(flns)),len(flns)))
+
+        if gif is not None: gif.close()
+        for k,(cube,cube_fln) in enumerate(zip(cubes,cube_flns)):
+            cube.close()
+            frames = Table({'flname': tab['flname'], 'MJD': tab['MJD'],
+                            'dx': tab['dx'], 'dy': tab['dy'],
+                            'x': [x[k] for x in tab['x']], 'y': [y[k] for y in tab['y']]})
+            with fits.open(cube_fln, mode='append') as hdul:
+                hdul.append(fits.BinTableHDU(frames, name='FRAMES'))
+
+        print('Stamps saved in '+path)
+        return cube_flns
+
+    def _movie_frame(self,flname,apass,matcher,target_id,PIX_EDGE=30):
+        """
+        Stars, labels and title of a single frame of the movie
+        (the arguments of render_frame), None if the catalogue of the
+        frame can not be read
+        """
+        vrb = self.vrb
+        ccd_pixscale = self.ccd_pixscale
+        exptime = self._hdr(flname,"EXPOSURE")
+        airmass = self._hdr(flname,"AIRMASS")
+        naxis1 = self._hdr(flname,"NAXIS1")
+        naxis2 = self._hdr(flname,"NAXIS2")
+        try: 
+            xbin= self._hdr(flname,"CCDXBIN")
+            ybin= self._hdr(flname,"CCDYBIN")
+            if xbin==ybin:
+                pixscale = ccd_pixscale * xbin
+            else:
+                pixscale = ccd_pixscale
+                print("Warning: different binning per axis")
+        except:
+            pixscale= ccd_pixscale
+            print("Warning: Binning not found in the header, FWHM not trustable")
+
+        try: data = self._read_catalogue(flname)
+        except: return None
+        msk = np.argwhere(data['FWHM_IMAGE'] >0 ).T[0]
+        PSF_FWHM = np.median(data['FWHM_IMAGE'][msk])
+        try:
+            seeing = self._hdr(flname,"L1FWHM")
+        except:
+            seeing = PSF_FWHM*pixscale
+        if seeing == "UNKNOWN": seeing = PSF_FWHM*pixscale
+        if vrb: print("Seeing = {:7.3f} arcsec".format(seeing))
+
+        #### Align images #####
+        d_x,d_y = self._shift(flname,data)
+
+        # Make mask due to separation
+        idx_apass, d2d_apass, ss = matcher.match(data['X_IMAGE']-d_x, data['Y_IMAGE']-d_y)
+
+        pp = (data['X_IMAGE'][ss] > PIX_EDGE ) & \
+             (data['X_IMAGE'][ss] < naxis1 -PIX_EDGE)  & \
+             (data['Y_IMAGE'][ss] > PIX_EDGE ) & \
+             (data['Y_IMAGE'][ss] < naxis2 -PIX_EDGE )
+        if 'MAG_ISO' in data.names: pp &= np.isfinite(data['MAG_ISO'][ss])
+        sel = np.argwhere(ss).T[0][pp]
+
+        #the target is the star in the row target_id-1 of the reference list
+        src_idx = np.argwhere(idx_apass[sel] == target_id-1).T[0]
+        src_idx = src_idx[0] if src_idx.size > 0 else None
+
+        #this is the size of the aperture in arcsec
+        ap_ind = self.aper_ind[0]
+        aper_size = pixscale * self.sizes[ap_ind]
+        try:
+            flux = data['FLUX_APER'][sel[src_idx],ap_ind]/exptime
+            eflux = data['FLUXERR_APER'][sel[src_idx],ap_ind]/exptime
+            title = 'Airmass: {:.2f} SEEING: {:.2f} Flux aper: {:.2e} +/- {:.2e}, aper: {:.2f} arcsec'.format(
+                airmass,seeing,flux,eflux,aper_size)
+        except:
+            title = 'ERROR with this frame'
+
+        return dict(fln=flname, x=data['X_IMAGE'][sel], y=data['Y_IMAGE'][sel],
+                    ids=apass.id.values[idx_apass[sel]], target=src_idx,
+                    text=flname.split('/')[-1], title=title)
 
-                gc.show_circles(x_im, y_im , radius=13,color='g',lw=3,animated=True)
-                
-                #here we write the src index in each image corresponding to the reference image
-                #we also identify the src index in the current image to substract the flux later. This is src_idx
-                src_idx = None #reset this for each loop 
-                for l in range(x_im.size):
-                    plt.text(x_im[l]+6, y_im[l]+6,int(apass.id.iloc[std_mag[ss][pp].index.values[l]]),fontsize='large',animated=True)
-                    
-                    #rule 
-                    if std_mag[ss][pp].index.values[l] == target_id-1:
-                        gc.show_circles(x_im[l], y_im[l] , radius=14,color='r',lw=5,animated=True)
-                        src_idx = l
-                        
-                    
-                plt.text(10,10,flname.split('/')[-1],fontsize='large')    
-                
-                    
-                
-                
-                #print()
-                #print(self.aper_ind)
-                #print(np.shape(mag_APER_err))
-                #print(np.shape(pp),np.shape(pp))
-                #print(mag_APER_err)
-                #m_pl = mag_APER[0][:,self.aper_ind][ss][pp]
-                #em_pl = mag_APER_err[0][:,self.aper_ind][ss][pp]
-                m_pl = flux_APER[0][:,self.aper_ind][ss][pp]
-                em_pl = flux_APER_err[0][:,self.aper_ind][ss][pp]
-                #this is the size of the aperture in arcsec
-                aper_size = pixscale * self.sizes[self.aper_ind]
-                #plt.title('Airmass: {:.2f} SEEING: {:.2f} MAG aper: {:.2f} +/- {:.2f}, aper: {:.2f} arcsec'.format(airmass,seeing,m_pl[src_idx],em_pl[src_idx],aper_size))
-                try:plt.title('Airmass: {:.2f} SEEING: {:.2f} Flux aper: {:.2e} +/- {:.2e}, aper: {:.2f} arcsec'.format(airmass,seeing,m_pl[src_idx],em_pl[src_idx],aper_size))
-                except:
-                    plt.title('ERROR with this frame')
-                #return src_idx
-                gc.savefig(self.workdir+self.name+'_files/fov{:1.0f}.jpg'.format(k))
-                print(k)
-                plt.close('all')
-                plt.clf()
-                mpl.collect() #this is to release the memory
-                
-                
-                
-        #creating the gif from jpgs   
-        import glob
-        from PIL import Image
-        lis = [li.split('/')[-1] for li in glob.glob(self.workdir+self.name+'_files/*.jpg')]
-        lis.sort(key=natural_keys)
-        frames = [Image.open(self.workdir+self.name+'_files/'+image) for image in lis]
-        frame_one = frames[0]
-                                                          
-        frame_one.save(self.workdir+self.name+'_files/'+self.name+self.marker+'_fov.gif', format="GIF", append_images=frames, save_all=True, fps=5, loop=0)
-        
-        #removing the temporal files
-        if clean_tmp: 
-            os.system('rm '+self.workdir+self.name+'_files/*.jpg')
-        
-                
-                
+    
+    def _journal_signature(self,apass,matcher,PIX_EDGE,save_standards,save_target,families):
+        """
+        Signature of a photometry run, stored at the top of the journal
+        """
+        #positions are rounded as the reference file is rewritten by every run
+        return [apass['id'].values.tolist(), np.round(apass[['x','y']].values,3).tolist(), PIX_EDGE,
+                [int(x) for x in self.aper_ind], self._ref_frame().split('/')[-1],
+                save_standards, save_target, list(families),
+                float(matcher.radius), bool(matcher.one_to_one),
+                None if self.adaptive is None else list(self.adaptive),
+                None if self.cog is None else list(self.cog)]
+
+    def _families(self,families):
+        """
+        Checks the list of measurement families to be saved
+        """
+        if families is None:
+            return MEASUREMENT_FAMILIES
+        for fam in families:
+            if fam not in MEASUREMENT_FAMILIES:
+                print('{} does not correspond to any SExtractor measurement, ignoring it'.format(fam))
+        return [fam for fam in MEASUREMENT_FAMILIES if fam in families]
+
+    def _read_journal(self,signature):
+        """
+        Reads the photometry journal written by photometry(incremental=True).
+
+        The journal is a sequence of pickled records: a header with the
+        signature of the run (reference stars and photometry options)
+        followed by one (name, stamp, rows) record per processed frame.
+        If the signature changed the journal is started again. A record
+        cut short by a crash is dropped and the journal is rewritten.
+
+        Returns
+        -------
+        dict of name: (stamp, rows)
+        """
+        self.path_journal = self.workdir+self.name+'_files/'+self.photo_file+'_journal.pkl'
+        records = {}
+        n_records = 0
+        matched, truncated = False, False
+        if Path(self.path_journal).exists():
+            size = os.path.getsize(self.path_journal)
+            with open(self.path_journal,'rb') as fl:
+                try:
+                    matched = pickle.load(fl) == signature
+                    while matched and fl.tell() < size:
+                        name, stamp, rows = pickle.load(fl)
+                        records[name] = (stamp, rows)
+                        n_records += 1
+                except (EOFError, pickle.UnpicklingError, ValueError):
+                    print('WARNING! >> Photometry journal truncated, dropping the last record')
+                    truncated = True
+
+        if not matched or truncated or n_records != len(records):
+            if self.vrb: print('Writing photometry journal '+self.path_journal)
+            with open(self.path_journal,'wb') as fl:
+                pickle.dump(signature, fl)
+                for name in records:
+                    pickle.dump((name,)+records[name], fl)
+        if self.vrb: print('{} frames in the photometry journal'.format(len(records)))
+
+        return records
+
+    def _write_journal(self,name,stamp,rows):
+        """
+        Appends the results of a single frame to the photometry journal
+        """
+        with open(self.path_journal,'ab') as fl:
+            pickle.dump((name, stamp, rows), fl)
+            fl.flush()
 
+    def _load_catalogue(self,fln):
+        """
+        Reads the catalogue of a frame into memory, None if it can not
+        be read (missing, corrupted or with other apertures). Used to
+        read the catalogues ahead of the photometry
+        """
+        try:
+            data = self._read_catalogue(fln)
+            if isinstance(data, CatalogueFrame):
+                data = CatalogueFrame({col: np.array(arr) for col,arr in data.items()})
+            return data
+        except (OSError, ValueError, KeyError) as err:
+            print('WARNING! >> catalogue of {} not read: {}'.format(fln, err))
+            return None
+
+    def _photometry_frame(self,i,flname,apass,matcher,ccd_pixscale,
+                          PIX_EDGE,vrb,save_standards,save_target,families,data=None):
+        """
+        Aligns the catalogue of a single frame to the reference frame
+        (see frame_aligner) and cross-matches it with the reference stars.
+
+        Returns the rows of the matched stars as a dict of column arrays
+        (empty if no star is saved) or None if the catalogue of the frame
+        can not be read
+        """
+        filt = self._hdr(flname,"FILTER")
+        #obj = fits.getval(flname,"OBJECT",0)
+        exptime = self._hdr(flname,"EXPOSURE")
+        mjd = self._mjd(flname)
+        airmass = self._hdr(flname,"AIRMASS")
+        naxis1 = self._hdr(flname,"NAXIS1")
+        naxis2 = self._hdr(flname,"NAXIS2")
+        try: 
+            xbin= self._hdr(flname,"CCDXBIN")
+            ybin= self._hdr(flname,"CCDYBIN")
+            if xbin==ybin:
+                pixscale = ccd_pixscale * xbin
+            else:
+                pixscale = ccd_pixscale
+                print("Warning: different binning per axis")
+        except:
+            pixscale= ccd_pixscale
+            print("Warning: Binning not found in the header, FWHM not trustable")
+            
         
-    
-    def photometry(self,PIX_EDGE = 30, vrb = None , save_output = True,save_standards = True,save_target = True):
+        #creating a mask to elimitate 0 FWHM data
+        #hotfix for bad data
+        try:
+            if data is None: data = self._read_catalogue(flname)
+            msk = np.argwhere(data.FWHM_IMAGE >0 ).T[0]
+        except: return None
+        PSF_FWHM = np.median(data.FWHM_IMAGE[msk])
+        try:
+            seeing = self._hdr(flname,"L1FWHM")
+        except:
+            seeing = PSF_FWHM*pixscale
+        if seeing == "UNKNOWN": seeing = PSF_FWHM*pixscale
+        if vrb: print("Seeing = {:7.3f} arcsec".format(seeing))
+        if vrb: print("PSF FWHM = {:7.3f} arcsec".format(PSF_FWHM*pixscale))
+      
+
+
+        #### Align images #####
+        d_x,d_y = self._shift(flname,data)
+
+        if vrb: print("Filter: {}".format(filt))
+
+        # Make mask due to separation
+        idx_apass, d2d_apass, ss = matcher.match(data['X_IMAGE']-d_x, data['Y_IMAGE']-d_y)
+
+        pp = (data['X_IMAGE'][ss] > PIX_EDGE ) & \
+             (data['X_IMAGE'][ss] < naxis1 -PIX_EDGE)  & \
+             (data['Y_IMAGE'][ss] > PIX_EDGE ) & \
+             (data['Y_IMAGE'][ss] < naxis2 -PIX_EDGE )
+        if 'MAG_ISO' in data.names: pp &= np.isfinite(data['MAG_ISO'][ss])
+
+        if vrb: print("Number of Absolute detected stars {} \n ".format(pp.sum()))
+        #only the measurements in the catalogue, see minimal_param()
+        families = [fam for fam in families if 'FLUX_'+fam in data.names]
+
+        rows = {}
+        if ((pp.sum() >= 3)) & save_target & save_standards:
+            #catalogue rows of the matched stars, the masks are applied only once
+            sel = np.argwhere(ss).T[0][pp]
+            n = sel.size
+            rows['flname'] = np.full(n, flname, dtype=object)
+            rows['id_apass'] = apass.id.values[idx_apass[sel]]
+            rows['Filter'] = np.full(n, filt, dtype=object)
+            rows['MJD'] = np.full(n, mjd+exptime/86400./2.)
+            rows['epoch'] = np.full(n, i)
+            for fam in families:
+                if fam == 'APER': continue
+                rows['flux_'+fam] = data['FLUX_'+fam][sel]
+                rows['flux_err_'+fam] = data['FLUXERR_'+fam][sel]
+                rows['mag_'+fam] = data['MAG_'+fam][sel] + 2.5 * np.log10(exptime)
+                rows['mag_err_'+fam] = data['MAGERR_'+fam][sel]
+            rows['exptime'] = np.full(n, exptime)
+            rows['airmass'] = np.full(n, airmass)
+            rows['seeing'] = np.full(n, seeing)
+
+            #here we save the different apertures:
+            if 'APER' in families:
+                for x, ap_ind in enumerate(self.aper_ind):
+                    rows[f'flux_APER_{x+1}'] = data['FLUX_APER'][sel,ap_ind]
+                    rows[f'flux_err_APER_{x+1}'] = data['FLUXERR_APER'][sel,ap_ind]
+                    rows[f'mag_APER_{x+1}'] = data['MAG_APER'][sel,ap_ind] + 2.5 * np.log10(exptime)
+                    rows[f'mag_err_APER_{x+1}'] = data['MAGERR_APER'][sel,ap_ind]
+                if self.adaptive is not None:
+                    rows.update(self._adaptive_aperture(data, sel, PSF_FWHM, exptime))
+                if self.cog is not None:
+                    rows.update(self._cog_apertures(data, sel, exptime))
+        return rows
+
+    def _cog_apertures(self,data,sel,exptime):
+        """
+        Columns of the apertures interpolated on the curve of growth
+        (see set_cog_apertures) for the catalogue rows `sel`. All the
+        stars and diameters of the frame are interpolated at once
+        """
+        diameters, correct, snr_min = self.cog
+        flux_aper = np.asarray(data['FLUX_APER'], dtype=float)
+        flux = growth_curve(flux_aper[sel], self.sizes, diameters)
+        flux_err = growth_curve(data['FLUXERR_APER'][sel], self.sizes, diameters)
+        if correct:
+            #bright and clean stars of the whole frame
+            with np.errstate(invalid='ignore', divide='ignore'):
+                bright = flux_aper[:,-1]/data['FLUXERR_APER'][:,-1] >= snr_min
+            if 'FLAGS' in data.names: bright &= data['FLAGS'] == 0
+            if bright.sum() == 0: bright = None
+            apcor = aperture_correction(flux_aper, self.sizes, diameters, mask=bright)
+        else:
+            apcor = np.ones(len(diameters))
+        #zero point of the catalogue magnitudes
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ok = flux_aper[:,-1] > 0
+            zp = np.nanmedian(data['MAG_APER'][ok,-1] + 2.5*np.log10(flux_aper[ok,-1])) if ok.sum() > 0 else 0.
+
+        rows = {}
+        for k in range(len(diameters)):
+            f, e = flux[:,k]*apcor[k], flux_err[:,k]*apcor[k]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                rows[f'flux_COG_{k+1}'] = f
+                rows[f'flux_err_COG_{k+1}'] = e
+                rows[f'mag_COG_{k+1}'] = zp - 2.5*np.log10(f) + 2.5 * np.log10(exptime)
+                rows[f'mag_err_COG_{k+1}'] = 1.0857*e/f
+            rows[f'apcor_COG_{k+1}'] = np.full(sel.size, apcor[k])
+        return rows
+
+    def _adaptive_aperture(self,data,sel,fwhm,exptime):
+        """
+        Columns of the seeing-adaptive aperture of a frame (see
+        set_adaptive_aperture) for the catalogue rows `sel`. The same
+        diameter is used for all the stars of the frame, so the fluxes
+        are taken (or interpolated) from whole columns of FLUX_APER
+        """
+        k, interpolate = self.adaptive
+        sizes = np.asarray(self.sizes, dtype=float)
+        diam = float(np.clip(k*fwhm, sizes[0], sizes[-1])) if np.isfinite(fwhm) else np.nan
+        n = sel.size
+        rows = {}
+        if not np.isfinite(diam):
+            for col in ['flux','flux_err','mag','mag_err']:
+                rows[col+'_ADAPT'] = np.full(n, np.nan)
+        elif interpolate and sizes.size > 1:
+            #linear interpolation between the two closest apertures
+            j = int(np.clip(np.searchsorted(sizes, diam), 1, sizes.size-1))
+            w = (diam - sizes[j-1])/(sizes[j] - sizes[j-1])
+            f0, f1 = data['FLUX_APER'][sel,j-1], data['FLUX_APER'][sel,j]
+            flux = (1.-w)*f0 + w*f1
+            flux_err = (1.-w)*data['FLUXERR_APER'][sel,j-1] + w*data['FLUXERR_APER'][sel,j]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                #referred to the magnitude of the smaller aperture to keep the zero point
+                mag = data['MAG_APER'][sel,j-1] - 2.5*np.log10(flux/f0) + 2.5*np.log10(exptime)
+                mag_err = 1.0857*flux_err/flux
+            rows.update({'flux_ADAPT': flux, 'flux_err_ADAPT': flux_err,
+                         'mag_ADAPT': mag, 'mag_err_ADAPT': mag_err})
+        else:
+            j = int(np.argmin(np.abs(sizes - diam)))
+            diam = sizes[j]
+            rows['flux_ADAPT'] = data['FLUX_APER'][sel,j]
+            rows['flux_err_ADAPT'] = data['FLUXERR_APER'][sel,j]
+            rows['mag_ADAPT'] = data['MAG_APER'][sel,j] + 2.5 * np.log10(exptime)
+            rows['mag_err_ADAPT'] = data['MAGERR_APER'][sel,j]
+        rows['aper_ADAPT'] = np.full(n, diam)
+        return rows
+
+    def photometry(self,PIX_EDGE = 30, vrb = None , save_output = True,save_standards = True,save_target = True,
+                   incremental = False, families = None, match_radius = 2., one_to_one = False,
+                   prefetch_depth = 4):
         """
         Creates a single output file from all the catalogues. 
         Cross-matches the positions of each catalogue and assigns
@@ -628,6 +1928,30 @@ class Reduction:
         PIX_EDGE: int, optional
             This avoid all the detections close to the edge of the CCD 
             default: ~4arsec ~30 pix 
+
+        incremental: bool, optional
+            Keeps a journal with the results of every frame. When the
+            photometry is run again only the frames that are new, or
+            whose raw file or catalogue changed, are processed and the
+            output files are rebuilt from the journal. Default = False
+
+        families: list of str, optional
+            SExtractor measurements saved in the output files, any of
+            'ISO', 'ISOCOR', 'AUTO', 'BEST', 'PETRO' and 'APER'.
+            Default = None (all of them)
+
+        match_radius: float, optional
+            Maximum distance in pixels between a detection and its
+            reference star. Default = 2
+
+        one_to_one: bool, optional
+            If True, a reference star can only be matched to one
+            detection of a frame, the closest one. Default = False
+
+        prefetch_depth: int, optional
+            Number of catalogues read ahead in background threads while
+            a frame is processed, 0 to read them one at a time.
+            Default = 4
         """
         self.photo_file = self.name+self.marker+'_photo' #+'_'+self.measurement_id
         apass = pd.read_csv(self.workdir+self.name+'_files/'+self.name+self.marker+'_ref_stars.csv',
@@ -635,10 +1959,13 @@ class Reduction:
         apass.set_index('id')
 
         if vrb == None: vrb = self.vrb
+        families = self._families(families)
 
         
         
-        coo_apass = SkyCoord(apass['x']/1000.*u.deg, apass['y']/1000*u.deg)
+        #the KD-tree of the reference stars is built once for all the frames
+        matcher = PixelMatcher(apass['x'].values, apass['y'].values,
+                               radius=match_radius, one_to_one=one_to_one)
 
         num_flns = len(self.flns)
 
@@ -647,7 +1974,7 @@ class Reduction:
         
         df3 = {}
 
-        if lco_log.exists():
+        if lco_log.exists() and not incremental:
             print('Photometry file already exists')
             check_flag = True
         else:
@@ -669,213 +1996,69 @@ class Reduction:
             ccd_pixscale =0.1661
         else:
             ccd_pixscale = 0.14
-        
-        
-        for i,flname in enumerate(self.flns[:]):
-            flnt = flname.split('/')[-1]
-            if flnt.split('.')[-1] == 'fits':
-                flnt2 = flnt[:-5]+'_cat.fits'
-            elif flnt.split('.')[-1] == 'fit':
-                flnt2 = flnt[:-4]+'_cat.fits'
-                
-            cat_flname = self.workdir+self.catalogue+flnt2
-            #print(flname,cat_flname)
-            if check_flag :
-                if vrb: print(flname+" exists")
-            else:
-                print("Processing {:5.0f} / {:5.0f} : {}".format(i+1,num_flns,
-                        flname.split('/')[-1]))
 
-                filt = fits.getval(flname,"FILTER",0)
-                #obj = fits.getval(flname,"OBJECT",0)
-                exptime = fits.getval(flname,"EXPOSURE",0)
-                try: mjd_t = fits.getval(flname,"GPSTIME",0)[:-5]
-                except: mjd_t = fits.getval(flname,"UT",0)
-                mjd_t = mjd_t.replace(' ', 'T')
-                #
-                try: mjd = Time(mjd_t, format='fits', scale='utc').mjd
-                except: #hotfix for new latest software version 
-                    mjd_t =  fits.getval(flname,"DATE-OBS",0)+'T'+fits.getval(flname,"UT",0)
-                    mjd = Time(mjd_t, format='fits', scale='utc').mjd
-                airmass = fits.getval(flname,"AIRMASS",0)
-                naxis1 = fits.getval(flname,"NAXIS1",0)
-                naxis2 = fits.getval(flname,"NAXIS2",0)
-                try: 
-                    xbin= fits.getval(flname,"CCDXBIN",0)
-                    ybin= fits.getval(flname,"CCDYBIN",0)
-                    if xbin==ybin:
-                        pixscale = ccd_pixscale * xbin
-                    else:
-                        pixscale = ccd_pixscale
-                        print("Warning: different binning per axis")
-                except:
-                    pixscale= ccd_pixscale
-                    print("Warning: Binning not found in the header, FWHM not trustable")
-                    
-                
-                #creating a mask to elimitate 0 FWHM data
-                #hotfix for bad data
-                try: msk = np.argwhere(fits.getdata(cat_flname).FWHM_IMAGE >0 ).T[0]
-                except: continue
-                PSF_FWHM = np.median(fits.getdata(cat_flname).FWHM_IMAGE[msk])
-                try:
-                    seeing = fits.getval(flname,"L1FWHM",0)
-                except:
-                    seeing = PSF_FWHM*pixscale
-                if seeing == "UNKNOWN": seeing = PSF_FWHM*pixscale
-                if vrb: print("Seeing = {:7.3f} arcsec".format(seeing))
-                if vrb: print("PSF FWHM = {:7.3f} arcsec".format(PSF_FWHM*pixscale))
-                data = fits.getdata(cat_flname)
-              
-
-
-                #### Align images #####
-                d_x,d_y = 0.0,0.0
-
-                if i==0:
-                    c_ref = np.array([data['X_IMAGE'],data['Y_IMAGE']]).T
+        if not check_flag:
+            self.header_index()
+            self.decode_times()
+            #all the frames are aligned to the reference frame
+            self.frame_aligner()
+
+            if incremental:
+                journal = self._read_journal(self._journal_signature(apass,matcher,PIX_EDGE,
+                                                     save_standards,save_target,families))
+            rejected = self._rejected()
+
+            #frames to be processed, their catalogues are read ahead in background threads
+            plan = []
+            for i,flname in enumerate(self.flns[:]):
+                name = flname.split('/')[-1]
+                if name in rejected:
+                    plan.append((i, flname, name, None, 'rejected'))
+                    continue
+                cat_flname = self._cat_path(flname)
+                stamp = (os.path.getmtime(frame_path(flname)),
+                         os.path.getmtime(cat_flname) if os.path.isfile(cat_flname) else None)
+                cached = incremental and name in journal and journal[name][0] == stamp
+                plan.append((i, flname, name, stamp, 'journal' if cached else 'process'))
+            loaded = prefetch(self._load_catalogue, [p[1] for p in plan if p[4] == 'process'],
+                              depth=prefetch_depth)
+        else:
+            plan = [(i, flname, None, None, 'exists') for i,flname in enumerate(self.flns[:])]
+            loaded = prefetch(self._load_catalogue, [])
+
+        #the reading threads are stopped even if a frame fails
+        with closing(loaded):
+            for i,flname,name,stamp,action in plan:
+                if action == 'exists':
+                    if vrb: print(flname+" exists")
+                    continue
+                if action == 'rejected':
+                    if vrb: print("Rejected by the quality control: "+name)
+                    continue
+
+                if action == 'journal':
+                    if vrb: print("From journal {:5.0f} / {:5.0f} : {}".format(i+1,num_flns,name))
+                    rows = journal[name][1]
                 else:
-                    c_tar = np.array([data['X_IMAGE'],data['Y_IMAGE']]).T
-                    try:
-                        p, (pos_img, pos_img_rot) = aa.find_transform(c_ref, c_tar)
-                        d_x,d_y = p.translation[0],p.translation[1]
-                        print("Translation: (x, y) = ({:.2f}, {:.2f})".format(*p.translation))
-                    except: 
-                        print('WARNING! >> List of matching triangles exhausted before an acceptable transformation was found?!?!')
-                    
-
-                coo_image = SkyCoord((data['X_IMAGE']-d_x)/1000*u.deg, 
-                                     (data['Y_IMAGE']-d_y)/1000*u.deg)
-
-                if vrb: print("Filter: {}".format(filt))
-
-                idx_apass, d2d_apass, d3d_apass = coo_image.match_to_catalog_sky(coo_apass) #
-
-                # Make mask due to separation
-                ss = (d2d_apass.deg*1000 < 2)
-
-                std_mag = apass['x'][idx_apass]
-                ## %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
-                measurement_id_list = ['ISO', 'ISOCOR', 'APER', 'AUTO', 'BEST', 'PETRO']
-                flux_ISO = []
-                flux_ISO_err = []
-                mag_ISO = []
-                mag_ISO_err = []
-                
-                flux_ISO.append(data['FLUX_ISO'])
-                flux_ISO_err.append(data['FLUXERR_ISO'])
-                mag_ISO.append(data['MAG_ISO'] + 2.5 * np.log10(exptime))
-                mag_ISO_err.append(data['MAGERR_ISO'])
-                
-                flux_ISOCOR = []
-                flux_ISOCOR_err = []
-                mag_ISOCOR = []
-                mag_ISOCOR_err = []
-                
-                flux_ISOCOR.append(data['FLUX_ISOCOR'])
-                flux_ISOCOR_err.append(data['FLUXERR_ISOCOR'])
-                mag_ISOCOR.append(data['MAG_ISOCOR'] + 2.5 * np.log10(exptime))
-                mag_ISOCOR_err.append(data['MAGERR_ISOCOR'])
-                
-                flux_APER = []
-                flux_APER_err = []
-                mag_APER = []
-                mag_APER_err = []
-                
-                flux_APER.append(data['FLUX_APER'])
-                flux_APER_err.append(data['FLUXERR_APER'])
-                mag_APER.append(data['MAG_APER'] + 2.5 * np.log10(exptime))
-                mag_APER_err.append(data['MAGERR_APER'])
-
-                flux_APER = np.array(flux_APER)
-                flux_APER_err = np.array(flux_APER_err)
-                mag_APER = np.array(mag_APER)
-                mag_APER_err = np.array(mag_APER_err)
-            
-                flux_AUTO = []
-                flux_AUTO_err = []
-                mag_AUTO = []
-                mag_AUTO_err = []
-                
-                flux_AUTO.append(data['FLUX_AUTO'])
-                flux_AUTO_err.append(data['FLUXERR_AUTO'])
-                mag_AUTO.append(data['MAG_AUTO'] + 2.5 * np.log10(exptime))
-                mag_AUTO_err.append(data['MAGERR_AUTO'])
-                
-                flux_BEST = []
-                flux_BEST_err = []
-                mag_BEST = []
-                mag_BEST_err = []
-                
-                flux_BEST.append(data['FLUX_BEST'])
-                flux_BEST_err.append(data['FLUXERR_BEST'])
-                mag_BEST.append(data['MAG_BEST'] + 2.5 * np.log10(exptime))
-                mag_BEST_err.append(data['MAGERR_BEST'])
-                
-                flux_PETRO = []
-                flux_PETRO_err = []
-                mag_PETRO = []
-                mag_PETRO_err = []
-                
-                flux_PETRO.append(data['FLUX_PETRO'])
-                flux_PETRO_err.append(data['FLUXERR_PETRO'])
-                mag_PETRO.append(data['MAG_PETRO'] + 2.5 * np.log10(exptime))
-                mag_PETRO_err.append(data['MAGERR_PETRO'])
-
-
-                pp = np.isfinite(np.array(mag_ISO)[0][ss]) & \
-                     (data['X_IMAGE'][ss] > PIX_EDGE ) & \
-                     (data['X_IMAGE'][ss] < naxis1 -PIX_EDGE)  & \
-                     (data['Y_IMAGE'][ss] > PIX_EDGE ) & \
-                     (data['Y_IMAGE'][ss] < naxis2 -PIX_EDGE )
-                
-
-                if vrb: print("Number of Absolute detected stars {} \n ".format(pp.sum()))
-
-                if ((pp.sum() >= 3)) & save_target:
-                   if save_standards:
-                        for jj in np.arange(pp.sum()):
-                            df3[id3] = {'flname': flname, 'id_apass':apass.id.iloc[std_mag[ss][pp].index.values[jj]],
-                                 'Filter': filt,'MJD': mjd+exptime/86400./2.,
-                                 'epoch':i,
-                                 'flux_ISO': flux_ISO[0][ss][pp][jj],
-                                 'flux_err_ISO': flux_ISO_err[0][ss][pp][jj],
-                                 'mag_ISO': mag_ISO[0][ss][pp][jj],
-                                 'mag_err_ISO': mag_ISO_err[0][ss][pp][jj],
-                                 'flux_ISOCOR': flux_ISOCOR[0][ss][pp][jj],
-                                 'flux_err_ISOCOR': flux_ISOCOR_err[0][ss][pp][jj],
-                                 'mag_ISOCOR': mag_ISOCOR[0][ss][pp][jj],
-                                 'mag_err_ISOCOR': mag_ISOCOR_err[0][ss][pp][jj],
-                                 'flux_AUTO': flux_AUTO[0][ss][pp][jj],
-                                 'flux_err_AUTO': flux_AUTO_err[0][ss][pp][jj],
-                                 'mag_AUTO': mag_AUTO[0][ss][pp][jj],
-                                 'mag_err_AUTO': mag_AUTO_err[0][ss][pp][jj],
-                                 'flux_BEST': flux_BEST[0][ss][pp][jj],
-                                 'flux_err_BEST': flux_BEST_err[0][ss][pp][jj],
-                                 'mag_BEST': mag_BEST[0][ss][pp][jj],
-                                 'mag_err_BEST': mag_BEST_err[0][ss][pp][jj],
-                                 'flux_PETRO': flux_PETRO[0][ss][pp][jj],
-                                 'flux_err_PETRO': flux_PETRO_err[0][ss][pp][jj],
-                                 'mag_PETRO': mag_PETRO[0][ss][pp][jj],
-                                 'mag_err_PETRO': mag_PETRO_err[0][ss][pp][jj],
-                                 'exptime': exptime,
-                                 'airmass': airmass,
-                                 'seeing':seeing
-                                 }
-                            
-                            #here we save the different apertures:
-                            for x, ap_ind in enumerate(self.aper_ind):
-                                #print(x,ap_ind)
-                                df3[id3][f'flux_APER_{x+1}']= flux_APER[0,:,ap_ind][ss][pp][jj]
-                                df3[id3][f'flux_err_APER_{x+1}']= flux_APER_err[0,:,ap_ind][ss][pp][jj]
-                                df3[id3][f'mag_APER_{x+1}']= mag_APER[0,:,ap_ind][ss][pp][jj]
-                                df3[id3][f'mag_err_APER_{x+1}']= mag_APER_err[0,:,ap_ind][ss][pp][jj]
-                                
-                            #print()
-                            id3 += 1
+                    print("Processing {:5.0f} / {:5.0f} : {}".format(i+1,num_flns,name))
+                    data = next(loaded)
+                    #frames without a catalogue are not journaled, they are tried again in the next run
+                    if data is None: continue
+                    rows = self._photometry_frame(i,flname,apass,matcher,ccd_pixscale,PIX_EDGE,vrb,
+                                                  save_standards,save_target,families,data=data)
+                    if incremental:
+                        self._write_journal(name,stamp,{} if rows is None else rows)
+                    if rows is None or len(rows) == 0: continue
+
+                rows['flname'] = np.full(len(rows['epoch']), flname, dtype=object)
+                rows['epoch'] = np.full(len(rows['epoch']), i)
+                df3[id3] = rows
+                id3 += 1
         #############################################################################################
         if (len(df3) >= 1) & save_target:
-                sta = pd.DataFrame.from_dict(df3,"index")
+                #whole columns of every frame are concatenated at once
+                sta = pd.DataFrame({col: np.concatenate([df3[k][col] for k in df3])
+                                    for col in df3[0]})
                 sta = sta.sort_values(by=['id_apass','epoch'])
                 
                 self.out_df = sta 
@@ -906,16 +2089,28 @@ class Reduction:
                     if vrb: print('Done')
                     
                     #saving copying the headers of the reference image to the output files
-                    ccd = CCDData.read(self.path_to_ref_fits, unit='count')
+                    ref = self._ref_frame()
+                    #the header of a cube is read without its frames
+                    meta = CCDData.read(ref, unit='count').meta if split_id(ref)[1] is None \
+                           else frame_header(ref)
                     header_flag = True
-                    sta.meta= ccd.meta[6:]
+                    sta.meta= meta[6:]
                     sta.meta['Camera'] = int(self.marker[-1])
                     
                     #saving number of pixels in the metadata 
+                    #binning from the header index if sextractor was not run in this session
+                    binning = getattr(self,'binning',[])
+                    if len(binning) == 0 and self.headers is not None:
+                        binning = self.headers.BINNING.dropna().values
+                    if self.adaptive is not None:
+                        sta.meta['ADAPT_k_FWHM'] = self.adaptive[0]
+                    if self.cog is not None:
+                        for k, diam in enumerate(self.cog[0]):
+                            sta.meta[f'COG_{k+1}_d_pix'] = diam
                     for x, ap_ind in enumerate(self.aper_ind):
                         sta.meta[f'APER_{x+1}_d_pix'] = self.sizes[ap_ind]
                         #in arcsec
-                        bnn = float(np.unique(self.binning)[-1].split('x')[0])
+                        bnn = float(np.unique(binning)[-1].split('x')[0])
                         sta.meta[f'APER_{x+1}_d_pix'] = self.sizes[ap_ind] * bnn * self.ccd_pixscale
                         
                 else: header_flag = False
@@ -933,3 +2128,133 @@ class Reduction:
                   
                 
 
+#%%
+    def stream(self,poll=5.,timeout=None,callback=None,PIX_EDGE=30,settle=2.,vrb=None,
+               save_standards=True,save_target=True,families=None,match_radius=2.,one_to_one=False):
+        """
+        Follows the raw data folder during the night and reduces every
+        new frame matching `rule` as soon as it has been written:
+        SExtractor, alignment and cross-match with the reference stars.
+
+        This is a generator that yields a data frame with the matched
+        photometry of each new frame (same columns as photometry()).
+        The rows are also appended to '<name>_files/<name>_Cx_photo_live.csv'
+        and to the photometry journal, so photometry(incremental=True)
+        builds the final outputs without processing these frames again.
+
+        If there is no reference star list yet, it is created from the
+        first frame.
+
+        poll: float, optional
+            Seconds between two checks of the raw data folder. Default = 5
+
+        timeout: float, optional
+            Stop after this many seconds without new frames.
+            Default = None (never stop)
+
+        callback: function, optional
+            Called with the data frame of every new frame
+
+        settle: float, optional
+            Frames modified less than `settle` seconds ago are still being
+            written and are left for the next check. Default = 2
+
+        match_radius, one_to_one: as in photometry()
+
+        Example
+        -------
+        for epoch in op.stream(poll=2):
+            print(epoch[['id_apass','MJD','flux_APER_1']])
+        """
+        import time
+        if vrb == None: vrb = self.vrb
+        families = self._families(families)
+
+        self.photo_file = self.name+self.marker+'_photo'
+        live_fl = self.workdir+self.name+'_files/'+self.photo_file+'_live.csv'
+        workdir = os.path.abspath(self.workdir)
+        scratch = os.path.join(workdir, 'sextractor_tmp'+self.marker)
+        self._sextractor_files()
+        for attr in ['binning','fwhm_image','fwhm_image_pix']:
+            if not hasattr(self,attr): setattr(self,attr,[])
+
+        print("OPTICAM - Live light curve generator")
+        print('Following: '+self.workdir+self.rawdata+self.rule)
+
+        apass, journal = None, {}
+        settled = {} #frames of the files already written, checked only once
+        failed = set() #frames that SExtractor could not read, not tried again
+        last_frame = time.time()
+        try:
+            while True:
+                flns = np.sort(glob.glob(self.workdir+self.rawdata+self.rule))
+                #files still being written are left for the next check
+                for fl in flns:
+                    if fl not in settled and time.time() - os.path.getmtime(fl) > settle:
+                        settled[fl] = expand_cubes([fl]) if self.cubes else [fl]
+                flns = [fln for fl in flns if fl in settled for fln in settled[fl]]
+                new = [fln for fln in flns if fln.split('/')[-1] not in journal
+                       and fln.split('/')[-1] not in failed]
+                self._warn_uncalibrated([fln for fln in new if not self._cat_fresh(fln)])
+
+                for fln in new:
+                    name = fln.split('/')[-1]
+                    cat_flname = self._cat_path(fln)
+                    if not self._cat_fresh(fln):
+                        res = _sextractor_frame(os.path.abspath(fln), os.path.abspath(cat_flname),
+                                                self.config_fl_name, workdir, scratch, self.ccd_pixscale,
+                                                self.calib.masters if self.calib is not None else None)
+                        if res is None:
+                            print('WARNING! >> {} skipped, it will not be tried again'.format(name))
+                            failed.add(name)
+                            continue
+                        if self.config_cache:
+                            self.manifest[name] = self._frame_key(fln)
+                            self._write_manifest()
+                        if res[0] is not None: self.binning.append(res[0])
+                        self.fwhm_image.append(res[1])
+                        self.fwhm_image_pix.append(res[2])
+
+                    if fln not in self.flns:
+                        self.flns = np.sort(np.append(self.flns,fln))
+                    i = int(np.argwhere(self.flns == fln)[0][0])
+
+                    if apass is None:
+                        #first frame: reference stars, alignment reference and journal
+                        if not Path(self.path_ref_list).exists():
+                            self.creat_ref_list(number=i)
+                        apass = pd.read_csv(self.path_ref_list, comment="#")
+                        matcher = PixelMatcher(apass['x'].values, apass['y'].values,
+                                               radius=match_radius, one_to_one=one_to_one)
+                        self.frame_aligner()
+                        journal = self._read_journal(self._journal_signature(apass,matcher,PIX_EDGE,
+                                                             save_standards,save_target,families))
+                    if name in journal: continue
+
+                    #only the new frame is added, the index is saved at the end
+                    self.header_index(flns=[fln], save=False)
+                    stamp = (os.path.getmtime(frame_path(fln)), os.path.getmtime(cat_flname))
+                    print("Processing {:5.0f} : {}".format(i+1,name))
+                    rows = self._photometry_frame(i,fln,apass,matcher,self.ccd_pixscale,
+                                                  PIX_EDGE,vrb,save_standards,save_target,families)
+                    rows = {} if rows is None else rows
+                    self._write_journal(name,stamp,rows)
+                    journal[name] = (stamp, rows)
+
+                    epoch = pd.DataFrame(rows)
+                    if len(epoch) > 0:
+                        epoch.to_csv(live_fl, mode='a', index=False,
+                                     header=not Path(live_fl).exists())
+                    last_frame = time.time()
+                    if callback is not None: callback(epoch)
+                    yield epoch
+
+                if len(new) == 0:
+                    if timeout is not None and time.time() - last_frame > timeout:
+                        print('No new frames in {:.0f} s, stopping'.format(timeout))
+                        shutil.rmtree(scratch, ignore_errors=True)
+                        return
+                    time.sleep(poll)
+        finally:
+            if self.headers is not None: self.headers.to_pickle(self._headers_path())
+
@@ -0,0 +1,102 @@
+import numpy as np
+import warnings
+from astropy.io import fits
+from astropy.stats import sigma_clip
+from .opticam_cube import FrameReader
+
+
+#%%%
+def read_section(fln, y0, y1, x0, x1):
+    """
+    Section [y0:y1, x0:x1] (0-based) of the image of a frame, read from
+    the memory-mapped file (or cube, see opticam_cube). The parts
+    outside the frame are NaN
+    """
+    out = np.full((y1-y0, x1-x0), np.nan, dtype=np.float32)
+    with FrameReader(fln) as fr:
+        ny, nx = fr.shape
+        a0, b0 = max(y0,0), max(x0,0)
+        a1, b1 = min(y1,ny), min(x1,nx)
+        if a1 > a0 and b1 > b0:
+            out[a0-y0:a1-y0, b0-x0:b1-x0] = fr.section(a0, a1, b0, b1)
+    return out
+
+
+def combine(cube, method='median', sigma=3.):
+    """
+    Combines a cube of frames (frames, y, x) along the first axis,
+    ignoring NaN. method is 'median' or 'mean' (sigma-clipped mean)
+    """
+    #pixels outside all the frames are left as NaN
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        if method == 'median':
+            return np.nanmedian(cube, axis=0)
+        clipped = sigma_clip(cube, sigma=sigma, axis=0, masked=False, copy=False)
+        return np.nanmean(clipped, axis=0)
+
+
+def stack_frames(flns, shifts, shape, scale=None, method='median', sigma=3.,
+                 max_memory=512, bias=None, dark=None, exptime=None, vrb=False):
+    """
+    Stacks frames into the geometry of the reference frame.
+
+    The output is built tile by tile: for every tile only that section
+    of each frame is read from the memory-mapped files, so the memory
+    used is bounded by `max_memory` whatever the number of frames.
+
+    flns: list of str
+        Frames to be combined
+
+    shifts: float, array (N,2)
+        Shift (dx, dy) of every frame with respect to the reference
+        frame (see FrameAligner), rounded to whole pixels
+
+    shape: tuple
+        Shape (ny, nx) of the reference frame
+
+    scale: float, array, optional
+        Factor applied to every frame before combining them (e.g. to
+        normalise the exposure time). Default = None
+
+    method: str, optional
+        'median' or 'mean' (sigma-clipped). Default = 'median'
+
+    max_memory: float, optional
+        Memory in MB of the cube of a tile. Default = 512
+
+    bias, dark: float, array (ny,nx), optional
+        Master bias and dark current (per second) subtracted from the
+        frames before scaling them, dark times `exptime`. Only for
+        frames that are not shifted (calibration frames)
+
+    Returns the stacked image and the number of frames combined in
+    every pixel
+    """
+    ny, nx = shape
+    n = len(flns)
+    shifts = np.round(np.asarray(shifts, dtype=float)).astype(int).reshape(-1,2)
+    scale = np.ones(n, dtype=np.float32) if scale is None else np.asarray(scale, dtype=np.float32)
+    exptime = np.zeros(n) if exptime is None else np.asarray(exptime, dtype=float)
+
+    #largest tile that fits in memory: whole rows, or part of a row
+    npix = max(int(max_memory*1024**2 // (4*n)), 16)
+    th = max(npix // nx, 1)
+    tw = nx if th > 1 else min(npix, nx)
+
+    image = np.full((ny, nx), np.nan, dtype=np.float32)
+    count = np.zeros((ny, nx), dtype=np.int32)
+    for r0 in range(0, ny, th):
+        r1 = min(r0+th, ny)
+        for c0 in range(0, nx, tw):
+            c1 = min(c0+tw, nx)
+            cube = np.empty((n, r1-r0, c1-c0), dtype=np.float32)
+            for k,(fln,(dx,dy)) in enumerate(zip(flns, shifts)):
+                cube[k] = read_section(fln, r0+dy, r1+dy, c0+dx, c1+dx)
+                if bias is not None: cube[k] -= bias[r0:r1, c0:c1]
+                if dark is not None: cube[k] -= dark[r0:r1, c0:c1]*exptime[k]
+                cube[k] *= scale[k]
+            image[r0:r1, c0:c1] = combine(cube, method=method, sigma=sigma)
+            count[r0:r1, c0:c1] = np.isfinite(cube).sum(axis=0)
+        if vrb: print('Stacking rows {:5.0f} / {:5.0f}'.format(r1, ny))
+    return image, count
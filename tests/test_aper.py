@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from opticam.opticam_aper import growth_curve, best_aperture, aperture_correction
+
+
+def test_growth_curve_at_the_apertures():
+    sizes = np.array([4., 8., 12., 16.])
+    flux = np.array([[10., 30., 40., 45.], [1., 2., 3., 4.]])
+    assert np.allclose(growth_curve(flux, sizes, sizes), flux)
+
+
+def test_growth_curve_interpolates_linear_curves_exactly():
+    sizes = np.array([4., 8., 12.])
+    flux = 5.*sizes[None,:] + np.array([[0.], [10.]])
+    out = growth_curve(flux, sizes, [6., 10.])
+    assert out.shape == (2, 2)
+    assert np.allclose(out, 5.*np.array([6., 10.])[None,:] + np.array([[0.], [10.]]))
+
+
+def test_growth_curve_leading_dimensions_and_clipping():
+    sizes = np.array([4., 8.])
+    flux = np.ones((3, 5, 2)) * np.array([1., 2.])
+    out = growth_curve(flux, sizes, [2., 20.])
+    assert out.shape == (3, 5, 2)
+    #diameters outside the apertures are clipped to the range
+    assert np.allclose(out[...,0], 1.) and np.allclose(out[...,1], 2.)
+
+
+def test_growth_curve_needs_two_apertures():
+    with pytest.raises(ValueError):
+        growth_curve(np.ones((3, 1)), [16.], [16.])
+
+
+def test_aperture_correction_of_a_flat_curve():
+    sizes = np.array([4., 8., 12.])
+    flux = np.tile([50., 100., 100.], (10, 1))
+    apcor = aperture_correction(flux, sizes, [4., 8.])
+    assert np.allclose(apcor, [2., 1.])
+
+
+def test_best_aperture():
+    scatter = np.array([[0.3, 0.1, 0.2],
+                        [np.nan, 0.5, 0.4],
+                        [np.nan, np.nan, np.nan]])
+    assert best_aperture(scatter).tolist() == [1, 2, -1]
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from opticam.opticam_cube import split_id, frame_path, window_offset
+
+
+@pytest.mark.parametrize('fln, expected', [
+    ('raw/C1_cube.fits[12]', ('raw/C1_cube.fits', 12)),
+    ('raw/C1_cube.fits[0]', ('raw/C1_cube.fits', 0)),
+    ('raw/C1_frame.fits', ('raw/C1_frame.fits', None)),
+    ('raw/C1_[a].fits', ('raw/C1_[a].fits', None)),
+])
+def test_split_id(fln, expected):
+    assert split_id(fln) == expected
+
+
+def test_frame_path():
+    assert frame_path('raw/C1_cube.fits[3]') == 'raw/C1_cube.fits'
+    assert frame_path('raw/C1_frame.fits') == 'raw/C1_frame.fits'
+
+
+def test_window_offset_full_frame():
+    assert window_offset(fits.Header()) == (0., 0.)
+
+
+def test_window_offset_ltv():
+    header = fits.Header({'LTV1': -100., 'LTV2': -50.})
+    assert window_offset(header) == (100., 50.)
+
+
+def test_window_offset_orgsubf():
+    header = fits.Header({'XORGSUBF': 12, 'YORGSUBF': 7})
+    assert window_offset(header) == (12., 7.)
+
+
+def test_window_offset_subrect_binned():
+    #SUBRECT is unbinned and 1-based, the offset is in binned pixels
+    header = fits.Header({'SUBRECT': '101,600,51,300', 'CCDXBIN': 2, 'CCDYBIN': 2})
+    assert window_offset(header) == (50., 25.)
+
+
+def test_window_offset_bad_subrect():
+    assert window_offset(fits.Header({'SUBRECT': 'full'})) == (0., 0.)
+    assert np.all(np.isfinite(window_offset(fits.Header({'SUBRECT': '1,2,3'}))))
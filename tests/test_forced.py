@@ -0,0 +1,41 @@
+import numpy as np
+
+from opticam.opticam_forced import aperture_photometry
+
+
+def _stamps(n=2, size=21, bkg=10., flux=(1000., 500.)):
+    #flat background with a point source in the central pixel
+    stamps = np.full((n, size, size), bkg)
+    for i in range(n):
+        stamps[i, size//2, size//2] += flux[i]
+    x0 = np.array([101, 301])
+    y0 = np.array([51, 201])
+    return stamps, x0 + size//2, y0 + size//2, x0, y0
+
+
+def test_point_sources_and_background():
+    stamps, xc, yc, x0, y0 = _stamps()
+    flux, npix, bkg, bkg_std, n_ann = aperture_photometry(stamps, xc, yc, x0, y0,
+                                                          [2., 4.], 6., 9.)
+    assert flux.shape == npix.shape == (2, 2)
+    assert np.allclose(flux, [[1000., 1000.], [500., 500.]])
+    assert np.allclose(npix, np.pi*np.array([2., 4.])**2)
+    assert np.allclose(bkg, 10.) and np.allclose(bkg_std, 0.)
+    assert (n_ann > 0).all()
+
+
+def test_flat_stamp_has_no_flux():
+    stamps, xc, yc, x0, y0 = _stamps(flux=(0., 0.))
+    flux = aperture_photometry(stamps, xc, yc, x0, y0, [3.], 6., 9.)[0]
+    assert np.allclose(flux, 0.)
+
+
+def test_apertures_outside_the_frame_are_not_measured():
+    stamps, xc, yc, x0, y0 = _stamps()
+    #the first star is at the edge of the frame
+    stamps[0, :, :8] = np.nan
+    flux = aperture_photometry(stamps, xc, yc, x0, y0, [2., 4., 12.], 6., 9.)[0]
+    assert np.isfinite(flux[0,0]) and np.isnan(flux[0,1])
+    #larger than the stamp
+    assert np.isnan(flux[:,2]).all()
+    assert np.allclose(flux[1,:2], 500.)
@@ -0,0 +1,52 @@
+import threading
+import time
+
+import pytest
+
+from opticam.misc import prefetch
+
+
+def _slow_square(x):
+    #the first items are the slowest, so they finish last
+    time.sleep(0.02*(5-x) if x < 5 else 0)
+    return x*x
+
+
+@pytest.mark.parametrize('depth', [0, 1, 4, 20])
+def test_prefetch_keeps_the_order(depth):
+    assert list(prefetch(_slow_square, range(10), depth=depth)) == [x*x for x in range(10)]
+
+
+def test_prefetch_empty():
+    assert list(prefetch(_slow_square, [], depth=4)) == []
+
+
+def test_prefetch_depth_zero_is_lazy():
+    done = []
+    gen = prefetch(done.append, range(5), depth=0)
+    next(gen)
+    assert done == [0]
+
+
+def test_prefetch_reads_ahead_at_most_depth():
+    started = []
+    lock = threading.Lock()
+    def work(x):
+        with lock: started.append(x)
+        return x
+    gen = prefetch(work, range(20), depth=3, n_threads=2)
+    assert next(gen) == 0
+    time.sleep(0.05)
+    #the first result and at most `depth` more are submitted
+    assert len(started) <= 5
+    assert list(gen) == list(range(1, 20))
+
+
+def test_prefetch_raises_the_errors_of_the_items():
+    def work(x):
+        if x == 3: raise OSError('broken file')
+        return x
+    gen = prefetch(work, range(6), depth=2)
+    assert [next(gen) for _ in range(3)] == [0, 1, 2]
+    with pytest.raises(OSError):
+        next(gen)
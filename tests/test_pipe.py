@@ -0,0 +1,154 @@
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+import pytest
+from astropy.table import Table
+
+import opticam
+from opticam.opticam_align import PixelMatcher
+
+
+@pytest.fixture
+def op(tmp_path):
+    #a night without frames, enough for the catalogue and journal helpers
+    workdir = str(tmp_path)+'/'
+    os.makedirs(workdir+'tst_files')
+    os.makedirs(workdir+'catalogues')
+    op = opticam.Reduction(workdir=workdir, name='tst', rule='*C1*.fits', vrb=False)
+    op.flns = [workdir+'raw_data/frame_C1_0000.fits']
+    op.photo_file = op.name+op.marker+'_photo'
+    return op
+
+
+def _write_catalogue(op, n_aper, n_src=5):
+    #SExtractor saves the aperture columns as scalars with a single aperture
+    shape = (n_src,) if n_aper == 1 else (n_src, n_aper)
+    cat = Table({'NUMBER': np.arange(1, n_src+1),
+                 'X_IMAGE': np.linspace(10., 50., n_src),
+                 'Y_IMAGE': np.linspace(20., 60., n_src),
+                 'FLUX_APER': np.ones(shape), 'FLUXERR_APER': np.ones(shape),
+                 'MAG_APER': np.ones(shape), 'MAGERR_APER': np.ones(shape),
+                 'FWHM_IMAGE': np.full(n_src, 3.)})
+    cat_fln = op._cat_path(op.flns[0])
+    cat.write(cat_fln, format='fits', overwrite=True)
+    return cat_fln
+
+
+#%% catalogues and apertures
+def test_single_aperture_catalogue_is_2d(op):
+    op.sizes = np.array([16])
+    _write_catalogue(op, 1)
+    data = op._read_catalogue(op.flns[0])
+    for col in ['FLUX_APER','FLUXERR_APER','MAG_APER','MAGERR_APER']:
+        assert data[col].shape == (5, 1)
+    assert data['X_IMAGE'].shape == (5,)
+    assert data['FLUX_APER'][np.arange(5), 0].shape == (5,)
+
+
+def test_aperture_count_mismatch_raises(op):
+    op.sizes = np.array([8, 10])
+    _write_catalogue(op, 31)
+    with pytest.raises(ValueError):
+        op._read_catalogue(op.flns[0])
+    #and the photometry skips the frame instead of mislabelling the apertures
+    assert op._load_catalogue(op.flns[0]) is None
+
+
+def test_aperture_count_mismatch_is_not_fresh(op):
+    op.sizes = np.array([8, 10])
+    cat_fln = _write_catalogue(op, 31)
+    assert op._aper_width(cat_fln) == 31
+    assert not op._cat_fresh(op.flns[0])
+    _write_catalogue(op, 2)
+    assert op._cat_fresh(op.flns[0])
+
+
+def test_minimal_param_writes_two_apertures(op):
+    op.minimal_param(families=['APER'], sizes=[16])
+    assert op.sizes.tolist() == [16, 32]
+    with open(op.workdir+'minimal.param') as fl:
+        assert 'FLUX_APER(2)' in fl.read().split()
+    #the sizes are read back from the config file
+    op2 = opticam.Reduction(workdir=op.workdir, name='tst', rule='*C1*.fits', vrb=False)
+    assert op2.sizes.tolist() == [16, 32]
+
+
+def test_cog_apertures_need_two_apertures(op):
+    op.sizes = np.array([16])
+    with pytest.raises(ValueError):
+        op.set_cog_apertures([12.])
+
+
+def test_adaptive_aperture_with_a_single_aperture(op):
+    op.sizes = np.array([16])
+    _write_catalogue(op, 1)
+    data = op._read_catalogue(op.flns[0])
+    op.set_adaptive_aperture(k=2.)
+    rows = op._adaptive_aperture(data, np.arange(3), 5., 1.)
+    assert np.allclose(rows['flux_ADAPT'], 1.)
+    assert np.allclose(rows['aper_ADAPT'], 16.)
+
+
+#%% photometry journal
+def _signature(op, radius=2., shift=0.):
+    apass = pd.DataFrame({'id': [1, 2], 'x': [10.+shift, 20.], 'y': [30., 40.]})
+    matcher = PixelMatcher(apass.x.values, apass.y.values, radius=radius)
+    return op._journal_signature(apass, matcher, 30, True, True, ['ISOCOR','APER'])
+
+
+def _records(path):
+    out = []
+    with open(path, 'rb') as fl:
+        while fl.tell() < os.path.getsize(path):
+            out.append(pickle.load(fl))
+    return out
+
+
+def test_journal_signature(op):
+    sig = _signature(op)
+    assert sig == _signature(op, shift=1e-5)
+    assert sig != _signature(op, shift=0.1)
+    assert sig != _signature(op, radius=3.)
+    op.set_adaptive_aperture(k=1.5)
+    assert sig != _signature(op)
+
+
+def test_journal_round_trip(op):
+    sig = _signature(op)
+    assert op._read_journal(sig) == {}
+    op._write_journal('a.fits', (1., 2.), {'epoch': [0]})
+    op._write_journal('b.fits', (3., 4.), {})
+    journal = op._read_journal(sig)
+    assert journal == {'a.fits': ((1., 2.), {'epoch': [0]}), 'b.fits': ((3., 4.), {})}
+
+
+def test_journal_new_signature_starts_again(op):
+    op._read_journal(_signature(op))
+    op._write_journal('a.fits', (1., 2.), {})
+    sig = _signature(op, radius=3.)
+    assert op._read_journal(sig) == {}
+    assert _records(op.path_journal) == [sig]
+
+
+def test_journal_dedupe(op):
+    sig = _signature(op)
+    op._read_journal(sig)
+    op._write_journal('a.fits', (1., 2.), {'epoch': [0]})
+    op._write_journal('a.fits', (5., 6.), {'epoch': [1]})
+    assert op._read_journal(sig) == {'a.fits': ((5., 6.), {'epoch': [1]})}
+    #the journal is rewritten with a single record per frame
+    assert _records(op.path_journal) == [sig, ('a.fits', (5., 6.), {'epoch': [1]})]
+
+
+def test_journal_truncated_record_is_dropped(op):
+    sig = _signature(op)
+    op._read_journal(sig)
+    op._write_journal('a.fits', (1., 2.), {})
+    op._write_journal('b.fits', (3., 4.), {})
+    size = os.path.getsize(op.path_journal)
+    with open(op.path_journal, 'r+b') as fl:
+        fl.truncate(size-5)
+    assert list(op._read_journal(sig)) == ['a.fits']
+    assert _records(op.path_journal) == [sig, ('a.fits', (1., 2.), {})]